@@ -1,262 +1,104 @@
 import subprocess
 import sys
-import os
-import re
+import time
+import uuid
+import threading
+
+_RUN_STARTED = time.perf_counter()
 
 # --- 0. 自動安裝依賴套件 ---
 def install_package(package):
+    # 只探測是否已安裝 (find_spec)，不實際 import，避免啟動時就載入重量級模組
+    import importlib.util
     try:
-        __import__(package)
+        found = importlib.util.find_spec(package) is not None
     except ImportError:
+        found = False
+    if not found:
         print(f"📦 正在自動安裝 {package}...")
         subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
-install_package("xlsxwriter")
-install_package("pypdf")
-install_package("docx")
-install_package("pandas")
-install_package("google.generativeai")
 install_package("streamlit")
 
 # -------------------------------------------
 
 import streamlit as st
-import google.generativeai as genai
-import random
-import io
-import time
-from pypdf import PdfReader
-from docx import Document
-import pandas as pd
-
-# --- 1. 定義學科與題型映射 ---
-SUBJECT_Q_TYPES = {
-    "國語": ["國字注音", "造句", "單選題", "閱讀素養題", "句型變換", "簡答題"],
-    "數學": ["應用計算題", "圖表分析題", "填充題", "單選題", "是非題"],
-    "自然科學": ["實驗判讀題", "圖表分析題", "單選題", "是非題", "填充題", "配合題"],
-    "社會": ["地圖判讀題", "情境案例分析", "單選題", "是非題", "配合題", "簡答題"],
-    "英語": ["英語會話選擇", "詞彙搭配", "文意選填", "單選題", "閱讀理解"],
-    "": ["單選題", "是非題", "填充題", "簡答題"]
-}
-
-# --- 2. 檔案讀取工具 ---
-@st.cache_data
+import extraction
+import metrics
+from key_pool import KeyPool
+from scheduler import get_scheduler, request_context, PHASE1
+from memory import SpilledText, session_usage, process_rss, format_bytes
+from prompts import SUBJECT_Q_TYPES
+from streaming import StreamRenderer
+# pandas / google.generativeai 等較重的模組只在需要的階段才載入 (見各 Phase)
+
+# 每次互動 Streamlit 都會從頭重跑本檔；以下預算用來監控固定開銷
+COLD_START_BUDGET_MS = 3000   # process 啟動後第一次執行
+RERUN_BUDGET_MS = 150         # 之後每次重跑 (不含 AI 生成)
+MODEL_CATALOG_TTL = 3600      # 模型清單快取秒數
+
+# --- 1. 檔案讀取工具 ---
 def extract_text_from_files(files):
-    text_content = ""
-    for file in files:
-        try:
-            file_text = ""
-            ext = file.name.split('.')[-1].lower()
-            if ext == 'pdf':
-                try:
-                    pdf_reader = PdfReader(file)
-                    for i, page in enumerate(pdf_reader.pages):
-                        content = page.extract_text() or ""
-                        file_text += f"\n--- Page {i+1} ---\n{content}"
-                except:
-                    file_text = "(PDF 讀取失敗，可能是加密或純圖片)"
-            elif ext == 'docx':
-                try:
-                    doc = Document(file)
-                    file_text = "\n".join([p.text for p in doc.paragraphs])
-                except:
-                    file_text = "(DOCX 讀取失敗)"
-            elif ext == 'doc':
-                file_text = "⚠️ 系統提示：本系統不支援舊版 Word (.doc)。請將檔案「另存新檔」為 .docx 或 .pdf 後重新上傳。"
-            
-            # 簡單清洗
-            file_text = re.sub(r'\n\s*\n', '\n\n', file_text)
-            text_content += f"\n\n=== 檔案: {file.name} ===\n{file_text}"
-        except Exception as e:
-            text_content += f"\n[讀取錯誤: {file.name} - {str(e)}]"
-    return text_content
-
-# --- 3. 資料處理工具 ---
-
-def parse_md_to_df(md_text):
-    """將 Markdown 表格解析為 Pandas DataFrame"""
-    try:
-        cleaned_text = md_text.replace("||", "|\n|")
-        lines = cleaned_text.strip().split('\n')
-        table_lines = []
-        is_table_started = False
-        
-        for line in lines:
-            if ("單元" in line or "目標" in line or "配分" in line) and "|" in line:
-                is_table_started = True
-                table_lines.append(line)
-                continue
-            if is_table_started:
-                if "---" in line: continue
-                if "|" in line: table_lines.append(line)
-        
-        if not table_lines: return None
-
-        data = []
-        for line in table_lines:
-            row = [cell.strip() for cell in line.strip('|').split('|')]
-            data.append(row)
-
-        if len(data) < 2: return None
-
-        headers = data[0]
-        rows = data[1:]
-        
-        max_cols = len(headers)
-        cleaned_rows = []
-        for r in rows:
-            if len(r) == max_cols: cleaned_rows.append(r)
-            elif len(r) < max_cols: cleaned_rows.append(r + [''] * (max_cols - len(r)))
-            else: cleaned_rows.append(r[:max_cols])
-
-        df = pd.DataFrame(cleaned_rows, columns=headers)
-        
-        # --- 🔥 強制清洗貪心題型 (只留第一個) ---
-        type_col = next((col for col in df.columns if "題型" in col), None)
-        if type_col:
-            def clean_type(x):
-                txt = str(x).replace(" ", "")
-                if "、" in txt: return txt.split("、")[0]
-                if "," in txt: return txt.split(",")[0]
-                if "或" in txt: return txt.split("或")[0]
-                return txt
-            df[type_col] = df[type_col].apply(clean_type)
-
-        # --- 🔥 配分自動校正 ---
-        score_col = next((col for col in df.columns if "配分" in col), None)
-        if score_col:
-            try:
-                def clean_number(x):
-                    nums = re.findall(r"[-+]?\d*\.\d+|\d+", str(x))
-                    return float(nums[0]) if nums else 0.0
-
-                df[score_col] = df[score_col].apply(clean_number)
-                current_total = df[score_col].sum()
-                
-                if current_total > 0 and current_total != 100:
-                    df[score_col] = (df[score_col] / current_total) * 100
-                
-                df[score_col] = df[score_col].round().astype(int)
-                
-                diff = 100 - df[score_col].sum()
-                if diff != 0:
-                    max_idx = df[score_col].idxmax()
-                    df.loc[max_idx, score_col] += diff
-            except: pass
-            
-        return df
-    except Exception as e: return None
-
-def df_to_excel(df):
-    """將 DataFrame 轉為 Excel bytes"""
-    try:
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='學習目標審核表')
-            workbook = writer.book
-            worksheet = writer.sheets['學習目標審核表']
-            
-            wrap_format = workbook.add_format({'text_wrap': True, 'valign': 'vcenter'})
-            header_format = workbook.add_format({
-                'bold': True, 'text_wrap': True, 'valign': 'vcenter', 
-                'fg_color': '#D7E4BC', 'border': 1
-            })
-            num_format = workbook.add_format({'valign': 'vcenter', 'align': 'center'})
-
-            for col_num, value in enumerate(df.columns.values):
-                worksheet.write(0, col_num, value, header_format)
-
-            worksheet.set_column(0, 0, 15, wrap_format)
-            worksheet.set_column(1, 1, 55, wrap_format) 
-            worksheet.set_column(2, 2, 20, wrap_format)
-            worksheet.set_column(3, 3, 10, num_format)
-                
-        return output.getvalue()
-    except Exception as e: return None
-
-def df_to_string(df):
-    """將 DataFrame 轉為文字字串，供 Prompt 使用"""
-    if df is None: return ""
-    return df.to_markdown(index=False)
-
-# --- 4. Prompt 指令集 ---
-
-GEM_INSTRUCTIONS_PHASE1 = """
-你是「國小專業定期評量命題 AI」。
-Phase 1 任務：閱讀教材，整理【學習目標審核表】。
-
-絕對規則：
-1. **配分邏輯**：根據篇幅與重要性，分配總分剛好 100 分。
-2. **單一題型**：「對應題型」欄位只能選「一種」最適合的題型 (如：單選題)。
-   (❌錯誤: 單選題、配合題 | ✅正確: 單選題)
-3. **數字格式**：「預計配分」欄位只能填阿拉伯數字。
-4. **格式要求**：僅輸出 Markdown 表格。
-"""
-
-GEM_INSTRUCTIONS_PHASE3 = """
-你是「國小專業定期評量命題 AI」，精通 1-6 年級全科教材教法。
-Phase 3 任務：依據使用者確認的【試題審核表】與【命題模式】進行正式出題。
-
-### 1. 核心參數：試卷模式 (Mode)
-請依據輸入的模式調整命題邏輯：
-* **🟢 模式 A：適中 (Moderate)**：基礎學力，題幹直接。
-* **🔴 模式 B：困難 (Hard)**：邏輯細節，多步驟解題。
-* **🌟 模式 C：素養 (Literacy)**：情境解決問題，接軌國際標準。
-
-### 2. 命題鐵律
-* **總分**：必須嚴格遵守審核表中的配分，總分 100。
-* **視覺化**：若題目需要圖片，請在題幹插入  標籤。
-* **選項品質**：干擾項必須合理，禁止「以上皆是/非」。
-
-### 3. 輸出格式
-請直接輸出試卷內容，包含題號、題目、選項、配分。
-"""
-
-# --- 5. 智能模型設定 (解決 404 與連線問題) ---
-def get_best_model(api_key, mode="fast"):
-    genai.configure(api_key=api_key)
-    try:
-        # 1. 獲取所有可用模型清單
-        models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-        if not models: return None, "找不到可用模型，請檢查 API Key 權限"
-        
-        target_model = None
-        
-        # 2. 搜尋邏輯
-        if mode == "fast":
-            # 優先找含有 flash 的模型
-            for m in models:
-                if 'flash' in m.lower(): target_model = m; break
-            if not target_model: target_model = models[0]
-            
-        elif mode == "smart":
-            # 優先找含有 pro 的模型
-            for m in models:
-                if 'pro' in m.lower() and '1.5' in m.lower(): target_model = m; break
-            if not target_model:
-                for m in models:
-                    if 'pro' in m.lower(): target_model = m; break
-            if not target_model: target_model = models[0]
-            
-        return target_model, None
-    except Exception as e: return None, str(e)
-
-def generate_with_retry(model_or_chat, prompt, stream=True):
-    max_retries = 3
-    for i in range(max_retries):
-        try:
-            if hasattr(model_or_chat, 'send_message'):
-                return model_or_chat.send_message(prompt, stream=stream)
-            else:
-                return model_or_chat.generate_content(prompt, stream=stream)
-        except Exception as e:
-            # 如果是 429 (Too Many Requests) 或其他網路問題
-            time.sleep((i + 1) * 2)
-            if i == max_retries - 1: raise e
-    raise Exception("連線逾時，請檢查網路")
-
-# --- 6. 介面設定 ---
+    # 實際工作交給 extraction 模組：檔案與 PDF 頁段分散到行程池平行抽取，
+    # 結果依檔案內容雜湊存入磁碟快取，所有 session 共用、重啟後仍有效
+    return extraction.extract_text_from_files(files)
+
+# --- 2. 模型與 API Key 池 ---
+@st.cache_resource
+def get_key_pool():
+    # 整個 process 共用一個 key 池：所有 session 的 429 / 冷卻狀態互相可見
+    return KeyPool()
+
+@st.cache_resource
+def get_model_catalog():
+    # 模型清單依 key 快取，避免每次按鈕都呼叫 genai.list_models()
+    from llm import ModelCatalog
+    return ModelCatalog(ttl=MODEL_CATALOG_TTL)
+
+@st.cache_resource(show_spinner=False)
+def ensure_dependencies():
+    # 依賴檢查每個 process 只做一次，不在每次重跑時重複 import 探測
+    for package in ("xlsxwriter", "pypdf", "docx", "pandas", "google.generativeai"):
+        install_package(package)
+    return True
+
+@st.cache_resource
+def get_run_stats():
+    return {"cold_start_ms": None, "reruns_ms": []}
+
+def record_run_overhead():
+    """記錄本次重跑的固定開銷 (腳本開頭到側欄繪製完成)，超出預算時寫入 log"""
+    elapsed_ms = (time.perf_counter() - _RUN_STARTED) * 1000
+    stats = get_run_stats()
+    if stats["cold_start_ms"] is None:
+        stats["cold_start_ms"] = elapsed_ms
+        budget = COLD_START_BUDGET_MS
+    else:
+        stats["reruns_ms"] = (stats["reruns_ms"] + [elapsed_ms])[-100:]
+        budget = RERUN_BUDGET_MS
+    metrics.observe("app_rerun_seconds", elapsed_ms / 1000, kind="cold" if budget == COLD_START_BUDGET_MS else "rerun")
+    if elapsed_ms > budget:
+        print(f"⏱️ 重跑開銷 {elapsed_ms:.0f} ms 超出預算 {budget} ms", file=sys.stderr)
+    return stats
+
+def queue_message(status):
+    eta = f"約 {status['eta']} 秒" if status["eta"] < 90 else f"約 {round(status['eta'] / 60)} 分鐘"
+    return f"🚦 目前使用人數較多，排隊中：第 {status['position']} 位 (本頁尚有 {status['waiting']} 個請求等待)，預估等待{eta}"
+
+def queue_notice(placeholder):
+    """排程器的 on_wait 回呼：排隊時顯示位置與預估等待，輪到後清除。
+    分段並行時由背景執行緒呼叫，需先掛上本次重跑的 script context 才能更新介面"""
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+    ctx = get_script_run_ctx()
+    def on_wait(status):
+        if get_script_run_ctx() is None: add_script_run_ctx(threading.current_thread(), ctx)
+        if not status["waiting"]: placeholder.empty()
+        else: placeholder.info(queue_message(status))
+    return on_wait
+
+# --- 3. 介面設定 ---
 st.set_page_config(page_title="內湖國小 AI 輔助出題系統", layout="wide")
+ensure_dependencies()
 
 st.markdown("""
     <style>
@@ -303,13 +145,44 @@ if "phase" not in st.session_state: st.session_state.phase = 1
 if "chat_history" not in st.session_state: st.session_state.chat_history = []
 if "df_preview" not in st.session_state: st.session_state.df_preview = None
 if "final_exam_content" not in st.session_state: st.session_state.final_exam_content = ""
+if "force_fresh_once" not in st.session_state: st.session_state.force_fresh_once = False
+if "sectioned" not in st.session_state: st.session_state.sectioned = True
+if "exam_warnings" not in st.session_state: st.session_state.exam_warnings = []
+# 上一版試卷與其審核表：回到編輯台修改後，只重新命題有變動的列
+if "last_exam" not in st.session_state: st.session_state.last_exam = None
+if "bank_reuse" not in st.session_state: st.session_state.bank_reuse = 30
+# 教材文字較大時存於暫存檔 (SpilledText)，session 只保留路徑
+if "material" not in st.session_state: st.session_state.material = None
+# 排程器依此輪流分配各 session 的請求名額
+if "session_id" not in st.session_state: st.session_state.session_id = uuid.uuid4().hex
+# 目前附掛的 Phase 3 背景工作；總分達 100 時是否預先在背景命題
+if "exam_job_id" not in st.session_state: st.session_state.exam_job_id = None
+if "speculate" not in st.session_state: st.session_state.speculate = True
+
+# 重新整理後 session 是全新的：依網址上的 ?job= 找回背景工作，還原審核表與參數並回到 Phase 3
+if st.session_state.phase == 1 and st.session_state.exam_job_id is None and st.query_params.get("job"):
+    from jobs import get_job_manager
+    restored = get_job_manager().get(st.query_params["job"])
+    if restored is not None and restored.kind == "phase3":
+        import pandas as pd
+        inputs = restored.inputs
+        st.session_state.df_preview = pd.DataFrame(inputs["rows"], columns=inputs["columns"])
+        st.session_state.grade, st.session_state.subject, st.session_state.mode = inputs["grade"], inputs["subject"], inputs["mode"]
+        st.session_state.session_id = restored.session
+        st.session_state.exam_job_id = restored.id
+        st.session_state.phase = 3
+    else:
+        del st.query_params["job"]
 
 # --- Sidebar ---
 with st.sidebar:
     st.markdown("### 🚀 系統設定")
     api_input = st.text_area("在此輸入 API Key", height=80, placeholder="請貼上 Google AI Studio 金鑰...")
+    force_fresh = st.checkbox("🔁 強制重新生成 (略過快取)", value=False,
+                              help="相同教材、參數與審核表會直接重用先前的 AI 結果；勾選後一律重新呼叫模型。")
     if st.button("🔄 重置系統"):
         st.session_state.clear()
+        st.query_params.clear()
         st.rerun()
 
     st.markdown("### 📚 資源連結")
@@ -322,6 +195,116 @@ with st.sidebar:
     </div>
     """, unsafe_allow_html=True)
 
+    run_stats = record_run_overhead()
+    if run_stats["reruns_ms"]:
+        recent = sorted(run_stats["reruns_ms"])
+        st.caption(f"⏱️ 啟動 {run_stats['cold_start_ms']:.0f} ms｜重跑中位數 {recent[len(recent) // 2]:.0f} ms (預算 {RERUN_BUDGET_MS} ms)")
+
+    # 管理面板：各階段耗時、模型 / key 延遲分佈與 token 用量 (同時寫入 metrics.prom / events.jsonl)
+    with st.expander("📊 效能監控"):
+        counters, hists = metrics.registry.snapshot()
+        fmt_ms = lambda v: "-" if v is None else f"{v * 1000:,.0f}"
+        fmt_labels = lambda labels: " ".join(f"{k}={v}" for k, v in labels.items())
+        if hists:
+            rows = [f"| {h['metric'].removesuffix('_seconds')} {fmt_labels(h['labels'])} | {h['count']} | {fmt_ms(h['p50'])} | {fmt_ms(h['p95'])} | {fmt_ms(h['max'])} |" for h in hists]
+            st.markdown("| 項目 | 次數 | p50 ms | p95 ms | 最大 ms |\n|---|---|---|---|---|\n" + "\n".join(rows))
+        if counters:
+            st.markdown("| 計數 | 值 |\n|---|---|\n" + "\n".join(f"| {name} {fmt_labels(labels)} | {value:,.0f} |" for name, labels, value in counters))
+        sched = get_scheduler().snapshot()
+        st.caption(f"🚦 排程：執行中 {sched['running']} / 上限 {sched['limit']}｜排隊 {sched['waiting']}｜使用中 session {sched['sessions']}")
+        if st.button("💾 立即寫出指標檔"): metrics.registry.export()
+        st.caption(f"指標檔：{metrics.METRICS_DIR}")
+
+    # 本 session 保存的資料量 (大段教材已移至暫存檔，只計路徑) 與整個行程的常駐記憶體
+    session_bytes, session_items = session_usage(st.session_state)
+    with st.expander("🧠 記憶體用量"):
+        st.caption(f"本頁 {format_bytes(session_bytes)}｜整個行程 {format_bytes(process_rss())}")
+        st.markdown("| 項目 | 大小 |\n|---|---|\n" + "\n".join(f"| {name} | {format_bytes(size)} |" for name, size in session_items[:8]))
+        material = st.session_state.material
+        if material is not None and material.path:
+            st.caption(f"教材 {len(material):,} 字 ({format_bytes(material.nbytes)}) 存於暫存檔")
+
+# --- Phase 3 背景工作 ---
+def phase3_job(speculative=False):
+    """取得與目前審核表、參數相符的 Phase 3 背景工作，沒有就送出一個；回傳 (工作, 錯誤訊息)。
+    這裡只計算指紋與輸入：模型查詢、教材索引與上一版比對都在工作開始後才做，審核表編輯時不會變慢"""
+    from jobs import get_job_manager, phase3_work
+    from exports import df_digest, text_digest
+    # 題庫整個 process 共用 (與批次命題同一個實例與鎖)，命題結果跨 session 累積
+    from question_bank import get_question_bank
+
+    keys = [k.strip() for k in api_input.replace('\n', ',').split(',') if k.strip()]
+    if not keys: return None, "請輸入 API Key"
+    df = st.session_state.df_preview
+    fresh = force_fresh or st.session_state.force_fresh_once
+    exam_meta = (st.session_state.get('grade'), st.session_state.get('subject'), st.session_state.get('mode'))
+    last_exam = st.session_state.last_exam
+    # 輸入 (審核表、參數與上一版試卷) 相同的工作直接沿用，包含預先開始的推測性工作
+    fingerprint = text_digest(df_digest(df), *map(str, exam_meta), str(st.session_state.sectioned),
+                              str(st.session_state.bank_reuse), str(fresh), last_exam["text"] if last_exam else "")
+    manager = get_job_manager()
+    job = manager.find(st.session_state.session_id, fingerprint)
+    if job is not None:
+        if not speculative and job.speculative:
+            metrics.inc("phase3_speculative_hits")
+            manager.promote(job)
+        return job, None
+    # 審核表又被修改：先前還沒開始的推測性工作作廢
+    manager.cancel_speculative(st.session_state.session_id)
+
+    inputs = {"columns": list(df.columns), "rows": df.to_dict("records"), "grade": exam_meta[0], "subject": exam_meta[1],
+              "mode": exam_meta[2], "total_rows": len(df)}
+    # 強制重新生成時不沿用上一版的試題
+    work = phase3_work(manager, df.copy(), *exam_meta, get_key_pool(), keys, catalog=get_model_catalog(), force_fresh=fresh,
+                       sectioned=st.session_state.sectioned, bank=get_question_bank(),
+                       reuse_ratio=st.session_state.bank_reuse / 100, material=st.session_state.material,
+                       last_exam=None if fresh else last_exam)
+    job = manager.submit(st.session_state.session_id, "phase3", fingerprint, inputs, work, speculative=speculative)
+    if not speculative: st.session_state.force_fresh_once = False
+    return job, None
+
+def follow_job(job, poll=0.3):
+    """附掛背景工作並顯示進度直到結束，回傳最後的狀態；本次重跑被打斷也不影響工作本身"""
+    from jobs import get_job_manager, FINISHED, DONE
+    manager = get_job_manager()
+    snap = manager.snapshot(job)
+    already_done = snap["status"] == DONE
+    queue_slot = st.empty()
+    slots, shown, renderer, announced = None, [], None, False
+    while True:
+        progress = snap["progress"]
+        # 模型與沿用列數在工作開始後才決定
+        if not announced and "model" in progress:
+            announced = True
+            kept = progress.get("carried")
+            if kept:
+                st.toast(f"♻️ 沿用上一版 {kept} 列的試題，只重新命題 {job.inputs['total_rows'] - kept} 列 ({progress['model']})", icon="💡")
+            elif not already_done:
+                st.toast(f"切換至深度思考模式 ({progress['model']})...", icon="💡")
+        queue = progress.get("queue")
+        if queue and queue["waiting"]: queue_slot.info(queue_message(queue))
+        else: queue_slot.empty()
+        if "sections" in progress:
+            # 分段命題：各大題完成後各自顯示
+            if slots is None:
+                slots = [st.empty() for _ in progress["sections"]]
+                shown = [False] * len(slots)
+            for i, (title, text) in enumerate(zip(progress["sections"], progress["texts"])):
+                if text == shown[i]: continue
+                if text: slots[i].markdown(f"### {title}\n\n{text}")
+                else: slots[i].info(f"⏳ {title} 命題中...")
+                shown[i] = text
+        elif "text" in progress:
+            # 整份串流：只補上新增的文字，緩衝並節流刷新
+            if renderer is None: renderer = StreamRenderer(st.container())
+            renderer.write(progress["text"][len(renderer.text):])
+        if snap["status"] in FINISHED: break
+        time.sleep(poll)
+        snap = manager.snapshot(job)
+    if renderer is not None: renderer.close()
+    if snap["progress"].get("cached"): st.toast("⚡ 相同審核表已命題過，直接重播結果 (快取)", icon="💾")
+    return snap
+
 # --- Phase 1: 參數設定與教材上傳 ---
 if st.session_state.phase == 1:
     with st.container(border=True):
@@ -342,45 +325,68 @@ if st.session_state.phase == 1:
         
         st.divider()
         uploaded_files = st.file_uploader("5. 上傳教材檔案 (Word/PDF)", type=["pdf", "docx", "doc"], accept_multiple_files=True)
+        # 單檔與合計大小上限 (頁數超過上限的部分抽取時會截斷)
+        upload_errors = extraction.check_upload_limits(uploaded_files) if uploaded_files else []
+        for problem in upload_errors: st.error(f"❌ {problem}")
+        st.caption(f"單檔上限 {extraction.MAX_FILE_BYTES // 1048576} MB、合計 {extraction.MAX_TOTAL_BYTES // 1048576} MB、"
+                   f"最多 {extraction.MAX_TOTAL_PAGES:,} 頁")
         
         if st.button("🚀 產出學習目標審核表", type="primary", use_container_width=True):
             if not api_input: st.error("❌ 請輸入 API Key")
             elif not grade or not subject or not uploaded_files or not selected_types:
                 st.warning("⚠️ 請確認所有欄位已填寫")
+            elif upload_errors: st.warning("⚠️ 請移除超過大小上限的檔案")
             else:
                 with st.spinner("⚡ AI 正在分析教材..."):
+                    from llm import get_best_model
+                    from chunking import estimate_tokens, split_material
+                    from pipeline import analyze_material
+                    from dedup import dedupe_material
+                    
                     keys = [k.strip() for k in api_input.replace('\n', ',').split(',') if k.strip()]
-                    target_key = random.choice(keys)
+                    key_pool = get_key_pool()
+                    target_key = key_pool.best_key(keys)
                     
-                    # 動態搜尋模型，避免 404
-                    model_name, error_msg = get_best_model(target_key, mode="fast")
+                    # 動態搜尋模型，避免 404 (模型清單依 key 快取)
+                    model_name, error_msg = get_best_model(target_key, mode="fast", catalog=get_model_catalog())
                     
                     if error_msg: st.error(f"❌ API 錯誤：{error_msg}")
                     else:
                         content = extract_text_from_files(uploaded_files)
+                        # 去除每頁重複的頁首頁尾與跨檔案的重複頁，減少送給模型的 token
+                        content, dedup_stats = dedupe_material(content)
+                        if dedup_stats["chars_saved"] > 0:
+                            st.toast(f"🧹 已移除重複的頁首頁尾 {dedup_stats['lines_removed']} 行、重複頁面 {dedup_stats['pages_removed']} 頁，"
+                                     f"節省 {dedup_stats['chars_saved']:,} 字 (約 {dedup_stats['tokens_saved']:,} tokens)", icon="🧹")
                         try:
-                            st.toast(f"⚡ 啟動 AI 引擎 ({model_name})...", icon="🤖")
-                            model_fast = genai.GenerativeModel(
-                                model_name=model_name,
-                                system_instruction=GEM_INSTRUCTIONS_PHASE1, 
-                                generation_config={"temperature": 0.0}
-                            )
-                            chat = model_fast.start_chat(history=[])
-                            t_str = "、".join(selected_types)
-                            prompt_content = f"""
-                            任務：分析以下教材並產出審核表。
-                            【參數】年級：{grade}, 科目：{subject}, 可用題型：{t_str}
-                            【教材】{content}
-                            【步驟】
-                            1. 識別單元結構與學習目標。
-                            2. 依重要性與篇幅分配 100 分。
-                            3. 輸出 Markdown 表格。
-                            """
-                            response = generate_with_retry(chat, prompt_content, stream=False)
+                            chunks = split_material(content)
+                            if len(chunks) > 1:
+                                st.toast(f"📚 教材約 {estimate_tokens(content):,} tokens，分為 {len(chunks)} 段並行分析 ({model_name})...", icon="🤖")
+                                progress = st.progress(0.0, text="分段分析中...")
+                                on_progress = lambda done, total: progress.progress(done / total, text=f"分段分析中... {done}/{total}")
+                            else:
+                                st.toast(f"⚡ 啟動 AI 引擎 ({model_name})...", icon="🤖")
+                                on_progress = None
+                            # 邊生成邊顯示已完成的列，串流結束後才套用題型清洗與配分校正
+                            preview_caption = st.empty()
+                            preview = st.empty()
+                            def on_preview(partial_df):
+                                preview_caption.caption(f"📋 審核表生成中... 已完成 {len(partial_df)} 列")
+                                preview.dataframe(partial_df, use_container_width=True, hide_index=True)
+                            queue_slot = st.empty()
+                            with metrics.span("phase1", model=model_name), \
+                                 request_context(st.session_state.session_id, PHASE1, queue_notice(queue_slot)):
+                                df, raw_text = analyze_material(
+                                    content, grade, subject, selected_types, model_name,
+                                    pool=key_pool, keys=keys, force_fresh=force_fresh,
+                                    on_progress=on_progress, on_preview=on_preview
+                                )
                             
-                            if "|" in response.text and "單元" in response.text:
-                                st.session_state.chat_history.append({"role": "model", "content": response.text})
-                                st.session_state.df_preview = parse_md_to_df(response.text)
+                            if df is not None:
+                                st.session_state.chat_history.append({"role": "model", "content": raw_text})
+                                st.session_state.df_preview = df
+                                # 保留教材文字，Phase 3 依審核表各列檢索相關段落 (大檔存入暫存檔)
+                                st.session_state.material = SpilledText(content)
                                 st.session_state.phase = 2
                                 st.session_state.subject = subject 
                                 st.session_state.grade = grade
@@ -428,23 +434,27 @@ elif st.session_state.phase == 2:
             else:
                 st.success(f"✅ 目前總分：{total_score} 分")
 
-            excel_data = df_to_excel(edited_df)
+            # Excel 只在按下下載時才產生，並依表格內容記憶 (編輯表格不會重建活頁簿)
+            from exports import excel_bytes
             
             col1, col2 = st.columns([1, 1])
             with col1:
-                if excel_data:
-                    st.download_button(
-                        label="📥 下載 Excel 審核表",
-                        data=excel_data,
-                        file_name=f"內湖國小_{current_subject}_審核表.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
-                    )
+                st.download_button(
+                    label="📥 下載 Excel 審核表",
+                    data=lambda df=edited_df: excel_bytes(df),
+                    file_name=f"內湖國小_{current_subject}_審核表.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    on_click="ignore",
+                    use_container_width=True
+                )
             with col2:
                 if st.button("⬅️ 返回重來", use_container_width=True):
                     st.session_state.phase = 1
                     st.session_state.chat_history = []
                     st.session_state.df_preview = None
+                    st.session_state.material = None
+                    st.session_state.last_exam = None
+                    st.session_state.exam_job_id = None
                     st.rerun()
         else:
             st.error("⚠️ 資料遺失，請重新生成。")
@@ -452,6 +462,29 @@ elif st.session_state.phase == 2:
     st.divider()
     
     # --- Phase 3 入口 ---
+    st.session_state.sectioned = st.toggle(
+        "⚡ 依題型分段並行命題 (較快)", value=st.session_state.sectioned,
+        help="各大題同時生成後再依審核表順序組合、重新編號；關閉則整份試卷一次生成。"
+    )
+    st.session_state.bank_reuse = st.select_slider(
+        "♻️ 由題庫重用試題的配分上限", options=[0, 10, 20, 30, 50, 70, 100],
+        value=st.session_state.bank_reuse, format_func=lambda v: f"{v}%",
+        disabled=not st.session_state.sectioned,
+        help="題庫中有相同年級、科目、模式、單元、題型與配分的試題時直接沿用，只為其餘各列呼叫模型。需開啟分段命題。"
+    )
+    st.session_state.speculate = st.toggle(
+        "🔮 總分為 100 分時預先在背景命題", value=st.session_state.speculate,
+        help="審核表停止修改幾秒後即開始命題，按下確認時常已完成；表格若再修改，會改以新內容命題 (會多使用 API 額度)。"
+    )
+    # 總分達 100 就先在背景命題 (延遲數秒、表格再變動即作廢)；放在各選項之後，指紋才會與正式命題一致
+    df_ready = st.session_state.df_preview
+    if st.session_state.speculate and api_input and df_ready is not None and df_ready["預計配分"].sum() == 100:
+        try: phase3_job(speculative=True)
+        except Exception: pass
+    else:
+        # 總分不再是 100 或關閉預先命題：先前的推測性工作 (含執行中的) 作廢
+        from jobs import get_job_manager
+        get_job_manager().cancel_speculative(st.session_state.session_id)
     if st.button("✅ 審核無誤，開始正式命題 (Phase 3)", type="primary", use_container_width=True):
         if st.session_state.df_preview is None:
             st.error("❌ 無法讀取審核表資料")
@@ -470,72 +503,73 @@ elif st.session_state.phase == 3:
         
         if not st.session_state.final_exam_content:
             with st.spinner("🧠 正在根據您的審核表與命題模式進行推理... (Pro 模型啟動中)"):
-                try:
-                    keys = [k.strip() for k in api_input.replace('\n', ',').split(',') if k.strip()]
-                    target_key = random.choice(keys)
-                    
-                    # Phase 3 也用動態搜尋，不硬性指定
-                    model_smart_name, error_msg = get_best_model(target_key, mode="smart")
-                    
-                    if error_msg: st.error(f"模型載入失敗：{error_msg}")
+                from jobs import get_job_manager, DONE
+                # 命題在背景工作中執行：本頁只附掛顯示進度，互動、重新整理或斷線都不會中斷命題
+                job = get_job_manager().get(st.session_state.exam_job_id)
+                error_msg = None
+                if job is None:
+                    try: job, error_msg = phase3_job()
+                    except Exception as e: error_msg = str(e)
+                if error_msg: st.error(f"模型載入失敗：{error_msg}")
+                else:
+                    st.session_state.exam_job_id = job.id
+                    # 網址帶上工作 id，重新整理後可重新附掛
+                    st.query_params["job"] = job.id
+                    snap = follow_job(job)
+                    if snap["status"] == DONE:
+                        st.session_state.final_exam_content = snap["result"]["text"]
+                        st.session_state.exam_warnings = snap["result"]["warnings"]
+                        st.session_state.last_exam = {"df": st.session_state.df_preview.copy(), "text": snap["result"]["text"],
+                                                      "meta": (st.session_state.get('grade'), st.session_state.get('subject'), st.session_state.get('mode'))}
+                        # 重新執行以顯示統一編號後的完整試卷
+                        st.rerun()
                     else:
-                        st.toast(f"切換至深度思考模式 ({model_smart_name})...", icon="💡")
-                        model_smart = genai.GenerativeModel(
-                            model_name=model_smart_name,
-                            system_instruction=GEM_INSTRUCTIONS_PHASE3
-                        )
-                        
-                        df_str = df_to_string(st.session_state.df_preview)
-                        
-                        final_prompt = f"""
-                        請根據以下【審核通過的架構表】進行命題。
-                        
-                        【基本資訊】
-                        年級：{st.session_state.get('grade')}
-                        科目：{st.session_state.get('subject')}
-                        命題模式：{st.session_state.get('mode')}
-                        
-                        【審核表 (請依此架構出題)】
-                        {df_str}
-                        
-                        【執行要求】
-                        1. 題目數量與配分需與表格完全一致。
-                        2. 若為素養模式，請務必設計情境題。
-                        3. 請包含  標籤以標示圖片需求。
-                        """
-                        
-                        response = generate_with_retry(model_smart, final_prompt, stream=True)
-                        full_text = ""
-                        msg_placeholder = st.empty()
-                        
-                        for chunk in response:
-                            if chunk.text:
-                                full_text += chunk.text
-                                msg_placeholder.markdown(full_text + "▌")
-                        
-                        msg_placeholder.markdown(full_text)
-                        st.session_state.final_exam_content = full_text
-                        
-                except Exception as e:
-                    st.error(f"命題失敗：{e}")
-                    if st.button("重試"): st.rerun()
+                        st.error(f"命題失敗：{snap['error'] or snap['status']}")
+                        if st.button("重試"):
+                            st.session_state.exam_job_id = None
+                            st.rerun()
         else:
+            for warning in st.session_state.exam_warnings:
+                st.warning(f"⚠️ 配分檢查：{warning}")
             st.markdown(st.session_state.final_exam_content)
 
         st.divider()
-        c1, c2 = st.columns([1, 1])
+        from exports import exam_docx_bytes
+        exam_text = st.session_state.final_exam_content
+        exam_title = f"內湖國小 {st.session_state.get('grade') or ''} {st.session_state.get('subject') or ''} 試卷初稿"
+        c1, c2, c3, c4 = st.columns([1, 1, 1, 1])
         with c1:
             st.download_button(
                 label="📥 下載試卷 (.txt)",
-                data=st.session_state.final_exam_content,
+                data=exam_text,
                 file_name=f"內湖國小_{st.session_state.get('subject')}_試卷初稿.txt",
                 mime="text/plain",
+                on_click="ignore",
                 use_container_width=True
             )
         with c2:
+            # DOCX 於下載時才產生，同一份試卷只轉檔一次
+            st.download_button(
+                label="📄 下載試卷 (.docx)",
+                data=lambda: exam_docx_bytes(exam_text, exam_title),
+                file_name=f"內湖國小_{st.session_state.get('subject')}_試卷初稿.docx",
+                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                on_click="ignore",
+                disabled=not exam_text,
+                use_container_width=True
+            )
+        with c3:
             if st.button("🔄 回到編輯台 (重新審核)", use_container_width=True):
                 st.session_state.phase = 2
                 st.session_state.final_exam_content = ""
+                st.session_state.exam_job_id = None
+                if "job" in st.query_params: del st.query_params["job"]
+                st.rerun()
+        with c4:
+            if st.button("♻️ 重新命題 (不使用快取)", use_container_width=True):
+                st.session_state.final_exam_content = ""
+                st.session_state.force_fresh_once = True
+                st.session_state.exam_job_id = None
                 st.rerun()
 
 st.markdown('<div class="custom-footer">© 2026 新竹市香山區內湖國小. All Rights Reserved.</div>', unsafe_allow_html=True)
@@ -0,0 +1,229 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from extraction import extract_text_from_files
+from key_pool import KeyPool
+from llm import get_best_model
+from dedup import dedupe_material
+from pipeline import analyze_material, generate_exam, generate_exam_sections
+from retrieval import get_index
+from exports import build_exam_docx
+from question_bank import get_question_bank
+from scheduler import request_context, PHASE1, PHASE3
+from prompts import SUBJECT_Q_TYPES
+from tables import parse_md_to_df, df_to_excel, df_to_string
+
+# --- 批次命題 (不需 Streamlit)：依清單產出各年級、各科的審核表與試卷 ---
+#
+# 每個工作輸出 審核表.xlsx、試卷.md 與 試卷.docx。
+#
+# 用法：python batch.py manifest.json --out 輸出目錄 --workers 3 --keys KEY1,KEY2
+#
+# manifest 可為 JSON 陣列、{"jobs": [...]} 或 JSONL，每個工作：
+#   {"id": "g3-science-A", "grade": "三年級", "subject": "自然科學",
+#    "mode": "🟢 模式 A：適中", "types": ["單選題", "是非題"], "files": ["教材/三上自然.pdf"]}
+# files 為相對於 manifest 所在目錄的路徑；types 省略時使用該科全部題型。
+# 產生的試題會存入本機題庫；--reuse 0.3 表示最多 30% 配分由題庫中相符的試題補上。
+# 每個工作完成一個階段就寫入 state.json，中斷後重新執行會從上次完成的階段繼續。
+
+DEFAULT_MODE = "🟢 模式 A：適中"
+STATE_FILE = "state.json"
+TABLE_MD = "審核表.md"
+TABLE_XLSX = "審核表.xlsx"
+EXAM_MD = "試卷.md"
+EXAM_DOCX = "試卷.docx"
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+
+def load_manifest(path):
+    """讀取工作清單，補上預設值並將檔案路徑轉為絕對路徑"""
+    with open(path, encoding="utf-8") as f:
+        raw = f.read()
+    try:
+        data = json.loads(raw)
+        jobs = data.get("jobs", []) if isinstance(data, dict) else data
+    except json.JSONDecodeError:
+        jobs = [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+    base = os.path.dirname(os.path.abspath(path))
+    seen = set()
+    for i, job in enumerate(jobs):
+        for field in ("grade", "subject", "files"):
+            if not job.get(field): raise ValueError(f"第 {i+1} 個工作缺少 {field}")
+        job.setdefault("mode", DEFAULT_MODE)
+        job.setdefault("types", SUBJECT_Q_TYPES.get(job["subject"], SUBJECT_Q_TYPES[""]))
+        job.setdefault("sectioned", True)
+        job["files"] = [f if os.path.isabs(f) else os.path.join(base, f) for f in job["files"]]
+        job_id = job.get("id") or f"{i+1:03d}_{job['grade']}_{job['subject']}"
+        job["id"] = re.sub(r'[\\/:*?"<>|\s]+', "_", job_id)
+        if job["id"] in seen: raise ValueError(f"工作 id 重複：{job['id']}")
+        seen.add(job["id"])
+    return jobs
+
+
+def _read_state(job_dir):
+    try:
+        with open(os.path.join(job_dir, STATE_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_state(job_dir, state):
+    # 先寫暫存檔再取代，避免中斷時留下半份 state.json
+    tmp = os.path.join(job_dir, STATE_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, os.path.join(job_dir, STATE_FILE))
+
+
+def _write_text(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def _read_material(job):
+    """抽取教材文字並去除重複的頁首頁尾與重複頁"""
+    content, stats = dedupe_material(extract_text_from_files(job["files"]))
+    if stats["chars_saved"] > 0:
+        log(f"{job['id']}：去重節省 {stats['chars_saved']:,} 字 (約 {stats['tokens_saved']:,} tokens)")
+    return content
+
+
+def _pick_model(pool, keys, mode):
+    model_name, error_msg = get_best_model(pool.best_key(keys), mode=mode)
+    if error_msg: raise RuntimeError(f"API 錯誤：{error_msg}")
+    return model_name
+
+
+def run_job(job, out_dir, pool, keys, force_fresh=False, reuse_ratio=0.0):
+    """執行單一工作的 Phase 1 → Phase 3，每個階段完成後寫入檢查點"""
+    job_dir = os.path.join(out_dir, job["id"])
+    os.makedirs(job_dir, exist_ok=True)
+    state = {} if force_fresh else _read_state(job_dir)
+    state.update({"id": job["id"], "status": "running", "error": None})
+    _write_state(job_dir, state)
+
+    # Phase 1：審核表 (已完成則從 審核表.md 讀回)
+    table_path = os.path.join(job_dir, TABLE_MD)
+    content = None
+    if state.get("table_done") and os.path.exists(table_path):
+        with open(table_path, encoding="utf-8") as f:
+            df = parse_md_to_df(f.read())
+    else:
+        log(f"{job['id']}：讀取教材 ({len(job['files'])} 個檔案)")
+        content = _read_material(job)
+        model_name = _pick_model(pool, keys, "fast")
+        log(f"{job['id']}：分析教材 ({model_name})")
+        # 各工作視同一個 session，由排程器輪流分配名額
+        with metrics.span("phase1", model=model_name), request_context(job["id"], PHASE1):
+            df, _ = analyze_material(content, job["grade"], job["subject"], job["types"], model_name,
+                                     pool=pool, keys=keys, force_fresh=force_fresh)
+        if df is None: raise RuntimeError("審核表格式異常")
+        _write_text(table_path, df_to_string(df))
+        excel_data = df_to_excel(df)
+        if excel_data:
+            with open(os.path.join(job_dir, TABLE_XLSX), "wb") as f:
+                f.write(excel_data)
+        state["table_done"] = True
+        _write_state(job_dir, state)
+    if df is None: raise RuntimeError("無法讀回審核表")
+
+    # Phase 3：試卷
+    if not (state.get("exam_done") and os.path.exists(os.path.join(job_dir, EXAM_MD))):
+        model_name = _pick_model(pool, keys, "smart")
+        log(f"{job['id']}：正式命題 ({model_name})")
+        # 從檢查點續跑時教材文字由文字快取取回，不會重新解析
+        if content is None: content = _read_material(job)
+        index = get_index(content)
+        with metrics.span("phase3", model=model_name, path="sections" if job["sectioned"] else "exam"), \
+             request_context(job["id"], PHASE3):
+            if job["sectioned"]:
+                exam_text, warnings = generate_exam_sections(df, job["grade"], job["subject"], job["mode"], model_name,
+                                                             pool=pool, keys=keys, force_fresh=force_fresh,
+                                                             bank=get_question_bank(), reuse_ratio=reuse_ratio, index=index)
+            else:
+                exam_text = generate_exam(df, job["grade"], job["subject"], job["mode"], model_name,
+                                          pool=pool, keys=keys, force_fresh=force_fresh, bank=get_question_bank(),
+                                          index=index)
+                warnings = []
+        _write_text(os.path.join(job_dir, EXAM_MD), exam_text)
+        with open(os.path.join(job_dir, EXAM_DOCX), "wb") as f:
+            f.write(build_exam_docx(exam_text, f"內湖國小 {job['grade']} {job['subject']} 試卷初稿"))
+        state.update({"exam_done": True, "warnings": warnings})
+
+    state.update({"status": "done", "finished_at": time.strftime("%Y-%m-%d %H:%M:%S")})
+    _write_state(job_dir, state)
+    return state
+
+
+def run_batch(jobs, out_dir, keys, workers=2, force_fresh=False, pool=None, reuse_ratio=0.0):
+    """以執行緒池執行所有工作；已完成的工作直接略過。回傳 {工作 id: 狀態}"""
+    os.makedirs(out_dir, exist_ok=True)
+    pool = pool or KeyPool()
+    results = {}
+
+    def run(job):
+        state = _read_state(os.path.join(out_dir, job["id"]))
+        if state.get("status") == "done" and not force_fresh:
+            log(f"{job['id']}：已完成，略過")
+            return job["id"], state
+        try:
+            state = run_job(job, out_dir, pool, keys, force_fresh, reuse_ratio)
+            log(f"{job['id']}：完成")
+        except Exception as e:
+            job_dir = os.path.join(out_dir, job["id"])
+            state = _read_state(job_dir)
+            state.update({"id": job["id"], "status": "failed", "error": str(e)})
+            _write_state(job_dir, state)
+            log(f"{job['id']}：失敗 - {e}")
+        return job["id"], state
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for job_id, state in executor.map(run, jobs):
+            results[job_id] = state
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="內湖國小 AI 輔助出題系統：批次命題")
+    parser.add_argument("manifest", help="工作清單 (JSON / JSONL)")
+    parser.add_argument("--out", default="batch_output", help="輸出目錄 (預設 batch_output)")
+    parser.add_argument("--workers", type=int, default=2, help="同時執行的工作數 (預設 2)")
+    parser.add_argument("--keys", default=None, help="API Key，多把以逗號分隔 (預設讀取 GEMINI_API_KEYS 環境變數)")
+    parser.add_argument("--force-fresh", action="store_true", help="略過回應快取並重跑已完成的工作")
+    parser.add_argument("--reuse", type=float, default=0.0, help="由題庫重用試題的配分比例 0~1 (預設 0，不重用)")
+    args = parser.parse_args(argv)
+
+    raw_keys = args.keys if args.keys is not None else (
+        os.environ.get("GEMINI_API_KEYS") or os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY") or ""
+    )
+    keys = [k.strip() for k in raw_keys.replace('\n', ',').split(',') if k.strip()]
+    if not keys:
+        print("❌ 請以 --keys 或 GEMINI_API_KEYS 環境變數提供 API Key", file=sys.stderr)
+        return 2
+
+    jobs = load_manifest(args.manifest)
+    log(f"共 {len(jobs)} 個工作，輸出至 {os.path.abspath(args.out)}")
+    results = run_batch(jobs, args.out, keys, workers=args.workers, force_fresh=args.force_fresh,
+                        reuse_ratio=args.reuse)
+    failed = [job_id for job_id, state in results.items() if state.get("status") != "done"]
+    log(f"完成 {len(results) - len(failed)} / {len(results)}" + (f"，失敗：{', '.join(failed)}" if failed else ""))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
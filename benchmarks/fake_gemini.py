@@ -0,0 +1,142 @@
+import re
+import time
+import random
+import threading
+
+# --- 離線替身：取代 genai.GenerativeModel，依 prompt 串流回傳擬真的審核表與試卷 ---
+#
+# install() 會替換 llm / pipeline 的 new_model 與模型清單查詢，之後整條 Phase 1 → Phase 3
+# 都不會連網。延遲與 429 比例可調，用來量測重試、換 key 與串流顯示的開銷。
+
+FAKE_MODELS = ["models/fake-1.5-flash", "models/fake-1.5-pro"]
+
+
+class ResourceExhausted(Exception):
+    """模擬 google.api_core 的 429 (key_pool.classify_error 依類別名稱與 code 判斷)"""
+    code = 429
+
+
+class _Usage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+
+
+class _Candidate:
+    def __init__(self, finish_reason):
+        self.finish_reason = finish_reason
+
+
+class _Chunk:
+    def __init__(self, text, usage=None, finish_reason="FINISH_REASON_UNSPECIFIED"):
+        self.text = text
+        self.usage_metadata = usage
+        self.candidates = [_Candidate(finish_reason)]
+
+
+class _Response:
+    def __init__(self, text, usage, finish_reason="STOP"):
+        self.text = text
+        self.usage_metadata = usage
+        self.candidates = [_Candidate(finish_reason)]
+
+
+class FakeBackend:
+    """替身的共用設定與統計：首字延遲、每段延遲、429 比例"""
+
+    def __init__(self, first_token=0.2, per_chunk=0.01, chunk_chars=40, error_rate=0.0, seed=0, finish_reason="STOP"):
+        self.first_token = first_token
+        self.finish_reason = finish_reason   # 最後一段的結束原因，可設為 MAX_TOKENS 模擬被截斷的輸出
+        self.per_chunk = per_chunk
+        self.chunk_chars = chunk_chars
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def _should_fail(self):
+        with self._lock:
+            self.calls += 1
+            fail = self._rng.random() < self.error_rate
+            if fail: self.errors += 1
+            return fail
+
+    def respond(self, system_instruction, prompt, stream):
+        if self._should_fail(): raise ResourceExhausted("429 Resource has been exhausted (e.g. check quota).")
+        text = phase1_table(prompt) if "Phase 1" in (system_instruction or "") else phase3_exam(prompt)
+        usage = _Usage(len(prompt) // 2, len(text) // 2)
+        if not stream:
+            time.sleep(self.first_token + self.per_chunk * (len(text) // self.chunk_chars))
+            return _Response(text, usage, self.finish_reason)
+        return self._stream(text, usage)
+
+    def _stream(self, text, usage):
+        time.sleep(self.first_token)
+        pieces = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)]
+        for n, piece in enumerate(pieces):
+            if n: time.sleep(self.per_chunk)
+            last = n == len(pieces) - 1
+            yield _Chunk(piece, usage if last else None, self.finish_reason if last else "FINISH_REASON_UNSPECIFIED")
+
+
+class FakeModel:
+    """GenerativeModel 替身：支援 generate_content 與 start_chat().send_message"""
+
+    def __init__(self, backend, model_name="models/fake-1.5-pro", system_instruction=None, **kwargs):
+        self.backend = backend
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+    def generate_content(self, prompt, stream=False):
+        return self.backend.respond(self.system_instruction, prompt, stream)
+
+    def start_chat(self, history=None):
+        return FakeChat(self)
+
+
+class FakeChat:
+    def __init__(self, model):
+        self.model = model
+
+    def send_message(self, prompt, stream=False):
+        return self.model.generate_content(prompt, stream=stream)
+
+
+def phase1_table(prompt):
+    """依 prompt 中的題型與「第 N 單元」產生審核表，配分合計 100"""
+    types = re.search(r"可用題型：([^\n,]+)", prompt)
+    types = types.group(1).split("、") if types else ["單選題"]
+    units = list(dict.fromkeys(re.findall(r"第\s*\d+\s*單元[^\n]{0,12}", prompt))) or ["第1單元"]
+    rows = []
+    for i in range(max(4, min(len(units) * 2, 12))):
+        unit = units[i % len(units)].strip()
+        rows.append(f"| {unit} | 能理解{unit}的重點概念 ({i + 1}) | {types[i % len(types)]} | {{score}} |")
+    base, extra = divmod(100, len(rows))
+    rows = [r.format(score=base + (1 if i < extra else 0)) for i, r in enumerate(rows)]
+    return "| 單元名稱 | 學習目標 | 對應題型 | 預計配分 |\n|---|---|---|---|\n" + "\n".join(rows)
+
+
+def phase3_exam(prompt):
+    """依 prompt 中的審核表列出題：每列一題，配分照抄"""
+    questions = []
+    for line in prompt.split("\n"):
+        cells = [c.strip() for c in line.strip().strip("|").split("|")]
+        if len(cells) < 4 or not line.strip().startswith("|") or "---" in line or "學習目標" in line: continue
+        try: score = int(float(cells[-1]))
+        except ValueError: continue
+        questions.append(f"{len(questions) + 1}. ({score}分) 關於「{cells[1]}」，下列敘述何者正確？\n"
+                         f"   (A) 選項甲 (B) 選項乙 (C) 選項丙 (D) 選項丁")
+    return "\n\n".join(questions) or "1. (100分) 請說明本單元重點。"
+
+
+def install(backend):
+    """讓 llm / pipeline 改用替身模型與假的模型清單"""
+    import llm
+    import pipeline
+    factory = lambda **kwargs: FakeModel(backend, **kwargs)
+    llm.new_model = factory
+    pipeline.new_model = factory
+    llm.list_generation_models = lambda api_key: list(FAKE_MODELS)
+    # 替身沒有真正的 client 可綁定
+    llm.bind_key = lambda model_or_chat, api_key: None
@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import argparse
+import tempfile
+import statistics
+
+# --- 離線效能基準：合成教材 + Gemini 替身，與 baseline.json 比較，退步超過容許值時以非 0 結束 ---
+#
+# 用法 (於專案根目錄)：
+#   python benchmarks/run.py                 # 執行並與基準比較
+#   python benchmarks/run.py --update        # 以本次結果覆寫基準 (換機器或確認的效能改善後)
+#   python benchmarks/run.py --only extract  # 只跑名稱含 extract 的項目
+# 基準值與機器有關，請在同一台 (或同規格的 CI) 機器上產生與比較。
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+TOLERANCE = 0.25          # 比基準慢超過 25% 視為退步
+ABS_SLACK = 0.005         # 極短的項目另給 5 ms 容許誤差，避免計時雜訊
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import make_pdf, make_docx, make_unit_text, Upload      # noqa: E402
+from fake_gemini import FakeBackend, install           # noqa: E402
+
+FAKE_KEYS = [f"AIzaFakeBenchmarkKey{i:04d}" for i in range(4)]
+
+
+def measure(func, repeat):
+    """執行 repeat 次，回傳中位數秒數 (每次先呼叫 func() 取得要計時的動作)"""
+    times = []
+    for _ in range(repeat):
+        action = func()
+        started = time.perf_counter()
+        action()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def bench_extract(pages=0, paragraphs=0):
+    from extraction import extract_text_from_files
+    files = []
+    if pages: files.append(Upload(f"book_{pages}p.pdf", make_pdf(pages)))
+    if paragraphs: files.append(Upload(f"notes_{paragraphs}.docx", make_docx(paragraphs)))
+
+    def setup():
+        for f in files: f.seek(0)
+        return lambda: extract_text_from_files(files, use_cache=False)
+    return setup
+
+
+def bench_extract_cached(pages):
+    from extraction import extract_text_from_files
+    files = [Upload(f"cached_{pages}p.pdf", make_pdf(pages, seed=1))]
+    extract_text_from_files(files)   # 先暖快取
+    return lambda: (lambda: extract_text_from_files(files))
+
+
+def _table_md(rows):
+    lines = ["| 單元名稱 | 學習目標 | 對應題型 | 預計配分 |", "|---|---|---|---|"]
+    lines += [f"| 第{i // 5 + 1}單元 | 能說明第 {i} 個概念的重點與應用 | {'單選題' if i % 2 else '是非題'} | {100 // rows} |"
+              for i in range(rows)]
+    return "\n".join(lines)
+
+
+def bench_parse(rows):
+    from tables import parse_md_to_df
+    md = _table_md(rows)
+    return lambda: (lambda: parse_md_to_df(md))
+
+
+def bench_excel(rows):
+    from tables import parse_md_to_df, df_to_excel
+    df = parse_md_to_df(_table_md(rows))
+    return lambda: (lambda: df_to_excel(df))
+
+
+def bench_dedup(pages):
+    """去重：課本與習作兩個檔案各有頁首頁尾 (含檢查：各檔的頁首頁尾已移除、各單元標題仍保留)"""
+    from dedup import dedupe_material
+    text = make_unit_text(pages // 2) + make_unit_text(
+        pages - pages // 2, seed=1, name="workbook.pdf", header="自然科學 三年級 習作", publisher="另一出版社")
+    units = {line for line in text.split("\n") if line.startswith("第") and "單元" in line}
+
+    def run():
+        content, _ = dedupe_material(text)
+        missing = [unit for unit in units if unit not in content]
+        if missing: raise RuntimeError(f"去重誤刪單元標題：{missing[:3]}")
+        kept = [line for line in ("範例出版社", "另一出版社", "上學期", "習作") if line in content]
+        if kept: raise RuntimeError(f"去重未移除頁首頁尾：{kept}")
+
+    return lambda: run
+
+
+def bench_pipeline(pages, error_rate, sectioned=True):
+    """完整流程：抽取 → 去重 → Phase 1 (串流) → Phase 3；每次使用空的回應快取與題庫"""
+    from extraction import extract_text_from_files
+    from dedup import dedupe_material
+    from key_pool import KeyPool
+    from llm import get_best_model, get_response_cache
+    from pipeline import analyze_material, generate_exam_sections, generate_exam
+    from retrieval import get_index
+    files = [Upload(f"pipeline_{pages}p.pdf", make_pdf(pages, seed=2))]
+
+    def run():
+        backend = FakeBackend(first_token=0.05, per_chunk=0.002, error_rate=error_rate, seed=pages)
+        install(backend)
+        get_response_cache().clear()
+        pool = KeyPool(rpm=6000)
+        content, _ = dedupe_material(extract_text_from_files(files))
+        fast, _ = get_best_model(FAKE_KEYS[0], mode="fast")
+        df, _ = analyze_material(content, "三年級", "自然科學", ["單選題", "是非題"], fast,
+                                 pool=pool, keys=FAKE_KEYS, on_preview=lambda partial: None)
+        if df is None: raise RuntimeError("替身審核表解析失敗")
+        smart, _ = get_best_model(FAKE_KEYS[0], mode="smart")
+        if sectioned:
+            generate_exam_sections(df, "三年級", "自然科學", "🟢 模式 A：適中", smart,
+                                   pool=pool, keys=FAKE_KEYS, index=get_index(content))
+        else:
+            generate_exam(df, "三年級", "自然科學", "🟢 模式 A：適中", smart, pool=pool, keys=FAKE_KEYS,
+                          index=get_index(content))
+
+    return lambda: run
+
+
+BENCHMARKS = {
+    "extract_pdf_20p": (lambda: bench_extract(pages=20), 5),
+    "extract_pdf_200p": (lambda: bench_extract(pages=200), 3),
+    "extract_pdf_800p": (lambda: bench_extract(pages=800), 1),
+    "extract_docx_200": (lambda: bench_extract(paragraphs=200), 5),
+    "extract_docx_2000": (lambda: bench_extract(paragraphs=2000), 3),
+    "extract_cached_200p": (lambda: bench_extract_cached(200), 5),
+    "parse_md_50_rows": (lambda: bench_parse(50), 20),
+    "parse_md_500_rows": (lambda: bench_parse(500), 10),
+    "df_to_excel_50_rows": (lambda: bench_excel(50), 10),
+    "df_to_excel_500_rows": (lambda: bench_excel(500), 5),
+    "dedup_200p": (lambda: bench_dedup(200), 5),
+    "pipeline_40p_sections": (lambda: bench_pipeline(40, 0.0), 3),
+    "pipeline_40p_single": (lambda: bench_pipeline(40, 0.0, sectioned=False), 3),
+    "pipeline_120p_429": (lambda: bench_pipeline(120, 0.3), 3),
+}
+
+
+def compare(results, baseline, tolerance):
+    """回傳退步項目 [(名稱, 本次, 基準)]"""
+    regressions = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if base is not None and seconds > base * (1 + tolerance) + ABS_SLACK:
+            regressions.append((name, seconds, base))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="內湖國小 AI 輔助出題系統：離線效能基準")
+    parser.add_argument("--only", default=None, help="只執行名稱包含此字串的項目")
+    parser.add_argument("--update", action="store_true", help="以本次結果覆寫 baseline.json")
+    parser.add_argument("--tolerance", type=float, default=None, help="容許的變慢比例 (預設取 baseline.json，否則 0.25)")
+    args = parser.parse_args(argv)
+
+    # 專案模組都在各基準內才載入；快取目錄需在那之前指到空的暫存目錄。
+    # 最先註冊、最後執行：metrics 在結束時寫出的指標檔也一併清除
+    cache_dir = tempfile.mkdtemp(prefix="questwiz-bench-")
+    os.environ["QUESTWIZ_CACHE_DIR"] = cache_dir
+    atexit.register(shutil.rmtree, cache_dir, True)
+
+    try:
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+    baseline = saved.get("benchmarks", {})
+    tolerance = args.tolerance if args.tolerance is not None else saved.get("tolerance", TOLERANCE)
+
+    results = {}
+    for name, (factory, repeat) in BENCHMARKS.items():
+        if args.only and args.only not in name: continue
+        results[name] = measure(factory(), repeat)
+        base = baseline.get(name)
+        change = f"  ({(results[name] / base - 1) * 100:+.0f}% vs 基準 {base * 1000:.1f} ms)" if base else ""
+        print(f"{name:<26} {results[name] * 1000:>10.1f} ms{change}", flush=True)
+
+    if args.update:
+        merged = {**baseline, **{name: round(seconds, 4) for name, seconds in results.items()}}
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump({"tolerance": tolerance, "benchmarks": dict(sorted(merged.items()))}, f, indent=2)
+            f.write("\n")
+        print(f"✅ 已更新基準：{BASELINE_PATH}")
+        return 0
+
+    regressions = compare(results, baseline, tolerance)
+    if regressions:
+        print(f"\n❌ 效能退步 (容許 {tolerance:.0%})：", file=sys.stderr)
+        for name, seconds, base in regressions:
+            print(f"   {name}: {seconds * 1000:.1f} ms，基準 {base * 1000:.1f} ms", file=sys.stderr)
+        return 1
+    missing = [name for name in results if name not in baseline]
+    if missing: print(f"⚠️ 尚無基準：{', '.join(missing)} (以 --update 建立)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
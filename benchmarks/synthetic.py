@@ -0,0 +1,84 @@
+import io
+import random
+
+# --- 合成教材：產生指定頁數的 PDF 與指定段落數的 DOCX，不需任何真實課本 ---
+
+UNITS = ["Plants", "Animals", "Weather", "Water", "Magnets", "Light", "Sound", "Rocks"]
+WORDS = ["root", "stem", "leaf", "flower", "seed", "insect", "mammal", "rain", "cloud", "temperature",
+         "evaporation", "magnet", "shadow", "mirror", "vibration", "mineral", "observe", "record", "compare", "measure"]
+ZH_UNITS = ["植物的身體", "動物的分類", "天氣的變化", "水的旅行", "磁鐵的祕密", "光的反射", "聲音的產生", "岩石與礦物"]
+ZH_CHARS = "植物的根莖葉花果實種子動物昆蟲哺乳類天氣溫度雨量雲蒸發磁鐵影子鏡子振動礦物觀察記錄比較測量"
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _page_lines(rng, page_no, lines_per_page):
+    unit = UNITS[(page_no // 12) % len(UNITS)]
+    # 每頁都有相同的頁首頁尾，讓去重流程也有事可做
+    lines = [f"Science Grade 3 - Unit {(page_no // 12) + 1}: {unit}"]
+    lines += [" ".join(rng.choice(WORDS) for _ in range(10)) for _ in range(lines_per_page)]
+    lines.append(f"- {page_no + 1} -   (c) Sample Publisher")
+    return lines
+
+
+def make_pdf(pages, lines_per_page=30, seed=0):
+    """產生 pages 頁的 PDF bytes (純文字 Helvetica，pypdf 可直接抽取)"""
+    rng = random.Random(seed)
+    objs = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(pages))
+    objs.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+    objs.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for i in range(pages):
+        body = " ".join(f"({_pdf_escape(line)}) '" for line in _page_lines(rng, i, lines_per_page))
+        stream = f"BT /F1 10 Tf 40 780 Td 12 TL {body} ET".encode("latin-1")
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                    f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>".encode())
+        objs.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, obj in enumerate(objs):
+        offsets.append(len(out))
+        out += f"{n + 1} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets: out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def make_docx(paragraphs, seed=0):
+    """產生含 paragraphs 段中文內文 (每 20 段一個單元標題) 的 DOCX bytes"""
+    from docx import Document
+    rng = random.Random(seed)
+    doc = Document()
+    for i in range(paragraphs):
+        if i % 20 == 0: doc.add_heading(f"第{i // 20 + 1}單元 {ZH_UNITS[(i // 20) % len(ZH_UNITS)]}", level=1)
+        doc.add_paragraph("".join(rng.choice(ZH_CHARS) for _ in range(120)))
+    output = io.BytesIO()
+    doc.save(output)
+    return output.getvalue()
+
+
+def make_unit_text(pages, units=2, lines_per_page=20, seed=0, name="units.pdf",
+                   header="自然科學 三年級 上學期", publisher="範例出版社"):
+    """產生抽取後格式的中文教材：每頁有頁首、頁碼與版權行，另有各單元的頁首 (pages 頁平均分給 units 個單元)"""
+    rng = random.Random(seed)
+    parts = [f"\n\n=== 檔案: {name} ===\n"]
+    per_unit = -(-pages // units)
+    for i in range(pages):
+        lines = [f"第{i // per_unit + 1}單元 {ZH_UNITS[(i // per_unit) % len(ZH_UNITS)]}", header]
+        lines += ["".join(rng.choice(ZH_CHARS) for _ in range(40)) for _ in range(lines_per_page)]
+        lines += [f"- {i + 1} -", f"© {publisher} 版權所有"]
+        parts.append(f"\n--- Page {i + 1} ---\n" + "\n".join(lines))
+    return "".join(parts)
+
+
+class Upload(io.BytesIO):
+    """模擬 Streamlit 的 UploadedFile (有 name、可 getvalue)"""
+
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
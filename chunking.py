@@ -0,0 +1,131 @@
+import os
+import re
+
+import pandas as pd
+
+from tables import normalize_scores
+
+# --- 大量教材的分段 (map) 與審核表合併 (reduce) ---
+
+CHUNK_TOKENS = int(os.environ.get("QUESTWIZ_CHUNK_TOKENS", "30000"))   # 每段教材的 token 上限
+
+FILE_HEADER_RE = re.compile(r"\n\n=== 檔案: (.*?) ===\n")
+PAGE_RE = re.compile(r"(?=\n--- Page \d+ ---\n)")
+PAGE_NO_RE = re.compile(r"\n--- Page (\d+) ---\n")
+PAGE_SPLIT_RE = re.compile(r"\n--- Page ([\d-]+) ---\n")   # 含逾時略過的「Page 3-18」
+UNIT_RE = re.compile(r"第\s*[一二三四五六七八九十\d]+\s*[單元課章]")
+UNIT_LINE_RE = re.compile(r"(?=\n[ \t#*]*第\s*[一二三四五六七八九十\d]+\s*[單元課章])")   # 以單元標題開頭的行之前
+CJK_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff\u3000-\u303f\uff00-\uffef]")
+
+
+def estimate_tokens(text):
+    """離線估算 token 數：中日韓字元約 1 字 1 token，其餘約 4 字元 1 token"""
+    cjk = len(CJK_RE.findall(text))
+    return cjk + (len(text) - cjk) // 4
+
+
+def _split_files(text):
+    """依「=== 檔案 ===」標頭拆成 [(檔名, 內文)]"""
+    parts = FILE_HEADER_RE.split(text)
+    files = []
+    if parts[0].strip(): files.append(("", parts[0]))
+    for i in range(1, len(parts), 2):
+        files.append((parts[i], parts[i + 1]))
+    return files
+
+
+def _segments(body, max_tokens):
+    """切段的最小單位：有頁面標記時為各頁；Word 檔沒有頁面，改依單元標題切開，仍過長的單元再依段落切開"""
+    if PAGE_NO_RE.search(body): return [p for p in PAGE_RE.split(body) if p]
+    segments = []
+    for unit in UNIT_LINE_RE.split(body):
+        if estimate_tokens(unit) <= max_tokens:
+            if unit: segments.append(unit)
+        else:
+            segments.extend(unit.splitlines(keepends=True))
+    return segments
+
+
+def _split_pages(name, body, max_tokens):
+    """單一檔案過大時依頁面 (Word 檔依單元 / 段落) 切段，盡量在新單元開始的地方斷開"""
+    pages = _segments(body, max_tokens)
+    chunks, current, current_tokens = [], [], 0
+    for page in pages:
+        tokens = estimate_tokens(page)
+        if current and current_tokens + tokens > max_tokens:
+            # 往回找本段後半部中新單元開始的頁面，讓單元不被切成兩半
+            cut = len(current)
+            for j in range(len(current) - 1, len(current) // 2, -1):
+                if UNIT_RE.search(current[j][:200]):
+                    cut = j
+                    break
+            chunks.append(current[:cut])
+            current = current[cut:]
+            current_tokens = sum(estimate_tokens(p) for p in current)
+        current.append(page)
+        current_tokens += tokens
+    if current: chunks.append(current)
+
+    out = []
+    for n, group in enumerate(chunks):
+        nums = [int(m.group(1)) for p in group for m in [PAGE_NO_RE.match(p)] if m]
+        if nums: label = f"{name} (第 {nums[0]}-{nums[-1]} 頁)"
+        else: label = f"{name} (第 {n + 1} 部分)" if len(chunks) > 1 else name
+        out.append(f"\n\n=== 檔案: {label} ===\n" + "".join(group))
+    return out
+
+
+def split_material(text, max_tokens=CHUNK_TOKENS):
+    """將教材切成數段，每段不超過 max_tokens；小檔案合併、大檔案依頁面 / 單元拆開"""
+    if estimate_tokens(text) <= max_tokens: return [text]
+    pieces = []
+    for name, body in _split_files(text):
+        block = f"\n\n=== 檔案: {name} ===\n{body}" if name else body
+        if estimate_tokens(block) <= max_tokens: pieces.append(block)
+        else: pieces.extend(_split_pages(name, body, max_tokens))
+
+    chunks, current, current_tokens = [], "", 0
+    for piece in pieces:
+        tokens = estimate_tokens(piece)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = "", 0
+        current += piece
+        current_tokens += tokens
+    if current: chunks.append(current)
+    return chunks
+
+
+def _row_key(row, cols):
+    return "\x1f".join(re.sub(r"\s+", "", str(row[c])) for c in cols)
+
+
+def merge_tables(dfs, weights):
+    """合併各段審核表：配分依各段篇幅加權，重複的學習目標合併後再校正為總分 100"""
+    pairs = [(df, w) for df, w in zip(dfs, weights) if df is not None and len(df)]
+    if not pairs: return None
+    columns = list(pairs[0][0].columns)
+    score_col = next((c for c in columns if "配分" in c), None)
+    total_weight = sum(w for _, w in pairs) or 1
+
+    frames = []
+    for df, w in pairs:
+        # 欄位名稱以第一段為準，依位置對齊
+        df = df.iloc[:, :len(columns)].copy()
+        df.columns = columns[:df.shape[1]]
+        df = df.reindex(columns=columns, fill_value="")
+        if score_col:
+            df[score_col] = pd.to_numeric(df[score_col], errors="coerce").fillna(0) * (w / total_weight)
+        frames.append(df)
+    merged = pd.concat(frames, ignore_index=True)
+
+    key_cols = [c for c in columns if c != score_col and ("單元" in c or "目標" in c)]
+    if key_cols:
+        keys = merged.apply(lambda r: _row_key(r, key_cols), axis=1)
+        first = ~keys.duplicated()
+        if score_col:
+            merged[score_col] = merged[score_col].groupby(keys).transform("sum")
+        merged = merged[first].reset_index(drop=True)
+
+    if score_col: normalize_scores(merged, score_col)
+    return merged
@@ -0,0 +1,135 @@
+import re
+import zlib
+import hashlib
+from collections import Counter, defaultdict
+
+from chunking import FILE_HEADER_RE, PAGE_SPLIT_RE, UNIT_RE, estimate_tokens
+
+# --- 教材去重：移除每頁重複的頁首頁尾 / 頁碼 / 版權宣告，以及跨檔案內容幾乎相同的頁面 ---
+#
+# 出版社 PDF 每頁都有相同的頁首頁尾，課本與習作又常有整頁重複；這些內容對命題沒有幫助，
+# 只會增加 Phase 1 的 token 數。去重在抽取之後、送給模型之前進行，並回報節省了多少。
+
+BOILERPLATE_MIN_PAGES = 3     # 至少出現在幾頁才視為頁首頁尾
+BOILERPLATE_RATIO = 0.8       # 且出現頁數達總頁數的比例 (只出現在部分頁面的單元頁首不算)
+BOILERPLATE_EDGE = 3          # 只檢查每頁最前 / 最後幾行 (頁首頁尾的位置)
+BOILERPLATE_MAX_LEN = 80      # 只檢查較短的行，避免誤刪正文
+DUP_MIN_CHARS = 40            # 過短的頁面不做重複比對
+DUP_THRESHOLD = 0.85          # 取樣片段的 Jaccard 相似度達此值視為重複頁
+SHINGLE = 8                   # 片段長度 (字)
+SAMPLE_MOD = 4                # 只保留雜湊值可被整除的片段，降低比對量
+
+DIGITS_RE = re.compile(r"\d+")
+SPACE_RE = re.compile(r"\s+")
+
+
+def _line_key(line):
+    # 頁碼等數字不同的行視為同一行，例如「- 12 -」與「- 13 -」
+    return DIGITS_RE.sub("#", SPACE_RE.sub("", line))
+
+
+def _split(text):
+    """拆成 [(檔名, [(頁碼, 內文)])]；檔名 None 表示檔案標頭之前的內容，頁碼 None 表示第一個頁面標記之前"""
+    parts = FILE_HEADER_RE.split(text)
+    files = [(None, parts[0])] + [(parts[i], parts[i + 1]) for i in range(1, len(parts), 2)]
+    out = []
+    for name, body in files:
+        pieces = PAGE_SPLIT_RE.split(body)
+        out.append((name, [(None, pieces[0])] + [(pieces[i], pieces[i + 1]) for i in range(1, len(pieces), 2)]))
+    return out
+
+
+def _join(files):
+    parts = []
+    for name, pages in files:
+        if name is not None: parts.append(f"\n\n=== 檔案: {name} ===\n")
+        for page, content in pages:
+            if page is not None: parts.append(f"\n--- Page {page} ---\n")
+            parts.append(content)
+    return "".join(parts)
+
+
+def _shingles(text):
+    grams = (text[i:i + SHINGLE] for i in range(max(len(text) - SHINGLE + 1, 1)))
+    return {h for h in (zlib.crc32(g.encode("utf-8")) for g in grams) if h % SAMPLE_MOD == 0}
+
+
+def _edge_lines(lines):
+    """頁首頁尾位置的行 index：前後各 BOILERPLATE_EDGE 個非空白行"""
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    return set(filled[:BOILERPLATE_EDGE] + filled[-BOILERPLATE_EDGE:])
+
+
+def _is_candidate(line):
+    # 單元標題 (chunking 分段與 Phase 1 辨識單元都靠它) 即使每頁都有也保留
+    return len(line.strip()) <= BOILERPLATE_MAX_LEN and not UNIT_RE.search(line)
+
+
+def _boilerplate(pages):
+    """找出出現在足夠多頁頁首頁尾位置的短行"""
+    counts = Counter()
+    for content in pages:
+        lines = content.split("\n")
+        counts.update({_line_key(lines[i]) for i in _edge_lines(lines) if _is_candidate(lines[i])})
+    threshold = max(BOILERPLATE_MIN_PAGES, len(pages) * BOILERPLATE_RATIO)
+    return {key for key, n in counts.items() if n >= threshold and key}
+
+
+def dedupe_material(text):
+    """回傳 (去重後教材, 統計)；統計含移除的行數、頁數、字數與估計 token 數"""
+    files = _split(text)
+    refs = [(fi, pi) for fi, (_, pages) in enumerate(files) for pi, (page, _) in enumerate(pages)]
+    contents = {ref: files[ref[0]][1][ref[1]][1] for ref in refs}
+    # 頁首頁尾依檔案各自統計：課本與習作各有不同的頁首與版權行，合併計算時都達不到門檻
+    boiler = [_boilerplate([content for page, content in pages if page is not None]) for _, pages in files]
+
+    lines_removed = 0
+    for ref in refs:
+        if boiler[ref[0]]:
+            kept = []
+            lines = contents[ref].split("\n")
+            edges = _edge_lines(lines)
+            for i, line in enumerate(lines):
+                if i in edges and _is_candidate(line) and _line_key(line) in boiler[ref[0]]: lines_removed += 1
+                else: kept.append(line)
+            contents[ref] = "\n".join(kept)
+
+    # 重複頁：完全相同以雜湊判斷，幾乎相同以取樣片段的 Jaccard 相似度判斷
+    pages_removed = 0
+    seen_exact = {}
+    sampled = {}
+    postings = defaultdict(list)
+    for ref in refs:
+        name, page = files[ref[0]][0], files[ref[0]][1][ref[1]][0]
+        flat = SPACE_RE.sub("", contents[ref])
+        if len(flat) < DUP_MIN_CHARS: continue
+        label = f"{name or ''} 第 {page} 頁" if page else (name or "")
+        digest = hashlib.sha1(flat.encode("utf-8")).digest()
+        original = seen_exact.get(digest)
+        if original is None:
+            shingles = _shingles(flat)
+            overlap = Counter(other for h in shingles for other in postings[h])
+            for other, common in overlap.most_common(3):
+                union = len(shingles) + len(sampled[other][0]) - common
+                if union and common / union >= DUP_THRESHOLD:
+                    original = sampled[other][1]
+                    break
+        if original is not None:
+            contents[ref] = f"\n(與 {original} 內容重複，已略過)\n"
+            pages_removed += 1
+            continue
+        seen_exact[digest] = label
+        sampled[ref] = (shingles, label)
+        for h in shingles: postings[h].append(ref)
+
+    for fi, pi in refs:
+        pages = files[fi][1]
+        pages[pi] = (pages[pi][0], contents[(fi, pi)])
+    result = re.sub(r"\n\s*\n", "\n\n", _join(files))
+    stats = {
+        "lines_removed": lines_removed,
+        "pages_removed": pages_removed,
+        "chars_saved": len(text) - len(result),
+        "tokens_saved": estimate_tokens(text) - estimate_tokens(result),
+    }
+    return result, stats
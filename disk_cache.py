@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# --- 本機磁碟快取 (SQLite + zlib)，跨 session 共用、重啟後仍保留 ---
+
+CACHE_DIR = os.environ.get("QUESTWIZ_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "questwiz"))
+
+
+@contextmanager
+def connect(path):
+    """開啟 SQLite 連線並包成一個交易；快取與題庫共用"""
+    # 多個 Streamlit 執行緒 / 行程共用同一個檔案：WAL 模式讓讀寫互不阻塞
+    conn = sqlite3.connect(path, timeout=10)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+class DiskCache:
+    """以 key 存取壓縮後 JSON 值的磁碟快取，總量超過上限時以 LRU 淘汰；可選擇設定存活時間 (秒)"""
+
+    def __init__(self, path, max_bytes, ttl=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with connect(self.path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries(accessed)")
+
+    def get(self, key):
+        """取出快取值；不存在或資料損毀時回傳 None"""
+        try:
+            with self._lock, connect(self.path) as conn:
+                row = conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None: return None
+                now = time.time()
+                if self.ttl is not None and now - row[1] > self.ttl:
+                    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    return None
+                conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+        except Exception:
+            return None
+
+    def set(self, key, value):
+        """寫入快取值並視需要淘汰最久未使用的項目"""
+        blob = zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"), 6)
+        if len(blob) > self.max_bytes: return
+        now = time.time()
+        try:
+            with self._lock, connect(self.path) as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, blob, len(blob), now, now),
+                )
+                self._evict(conn)
+        except Exception:
+            pass
+
+    def _evict(self, conn):
+        if self.ttl is not None:
+            conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes: return
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed ASC").fetchall():
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes: break
+
+    def stats(self):
+        """回傳 (筆數, 壓縮後總位元組)"""
+        with connect(self.path) as conn:
+            return conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+
+    def clear(self):
+        with self._lock, connect(self.path) as conn:
+            conn.execute("DELETE FROM entries")
@@ -0,0 +1,130 @@
+import io
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+from streaming import SECTION_RE
+
+# --- 匯出：下載時才產生檔案，並依內容雜湊記住結果 ---
+
+MAX_MEMO_ENTRIES = 32
+MAX_MEMO_BYTES = 64 * 1024 * 1024   # 記住的檔案合計大小上限
+
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+TABLE_LINE_RE = re.compile(r"^\s*\|.*\|\s*$")
+TABLE_SEP_RE = re.compile(r"^\s*\|?\s*:?-{3,}")
+BOLD_RE = re.compile(r"(\*\*[^*]+\*\*)")
+
+
+def df_digest(df):
+    """DataFrame 內容雜湊 (欄名 + 每格文字)，相同內容的表格得到相同結果"""
+    h = hashlib.sha256()
+    h.update("\x1f".join(map(str, df.columns)).encode("utf-8"))
+    for row in df.itertuples(index=False):
+        h.update(b"\x1e" + "\x1f".join(map(str, row)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def text_digest(*parts):
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def _memoize(kind, digest, build):
+    """同一內容只建一次檔案；最多保留 MAX_MEMO_ENTRIES 份、合計 MAX_MEMO_BYTES (LRU)"""
+    key = (kind, digest)
+    with _memo_lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key]
+    data = build()
+    if data:
+        with _memo_lock:
+            _memo[key] = data
+            _memo.move_to_end(key)
+            while len(_memo) > MAX_MEMO_ENTRIES: _memo.popitem(last=False)
+            while len(_memo) > 1 and sum(len(v) for v in _memo.values()) > MAX_MEMO_BYTES: _memo.popitem(last=False)
+    return data
+
+
+def excel_bytes(df):
+    """審核表 Excel (依表格內容記憶)"""
+    from tables import df_to_excel
+    return _memoize("xlsx", df_digest(df), lambda: df_to_excel(df) or b"")
+
+
+def exam_docx_bytes(text, title=""):
+    """試卷 DOCX (依試卷文字記憶)"""
+    return _memoize("docx", text_digest(title, text), lambda: build_exam_docx(text, title))
+
+
+# --- DOCX 試卷：逐行串流寫入，不先組出整份中間結構 ---
+
+def _iter_blocks(text):
+    """將 Markdown 試卷切成 ("table", 列) / ("heading", 等級, 文字) / ("para", 文字)"""
+    table = []
+    for line in text.splitlines():
+        if TABLE_LINE_RE.match(line):
+            if not TABLE_SEP_RE.match(line.strip().strip("|")):
+                table.append([c.strip() for c in line.strip().strip("|").split("|")])
+            continue
+        if table:
+            yield ("table", table)
+            table = []
+        stripped = line.strip()
+        if not stripped:
+            continue
+        elif stripped.startswith("#"):
+            level = min(len(stripped) - len(stripped.lstrip("#")), 3)
+            yield ("heading", level, stripped.lstrip("#").strip().strip("*"))
+        elif SECTION_RE.match(line):
+            yield ("heading", 2, stripped.strip("*"))
+        else:
+            yield ("para", stripped)
+    if table: yield ("table", table)
+
+
+def _add_runs(paragraph, text):
+    # **粗體** 轉為粗體 run
+    for piece in BOLD_RE.split(text):
+        if not piece: continue
+        if piece.startswith("**") and piece.endswith("**"):
+            paragraph.add_run(piece[2:-2]).bold = True
+        else:
+            paragraph.add_run(piece)
+
+
+def build_exam_docx(text, title=""):
+    """將試卷 Markdown 轉為排版過的 DOCX bytes"""
+    from docx import Document
+    from docx.shared import Pt
+    from docx.oxml.ns import qn
+
+    doc = Document()
+    style = doc.styles["Normal"]
+    style.font.size = Pt(12)
+    # 中文字型需另外指定 East Asian 字型才會生效
+    style.font.name = "Times New Roman"
+    style.element.rPr.rFonts.set(qn("w:eastAsia"), "標楷體")
+    if title: doc.add_heading(title, level=0)
+
+    for block in _iter_blocks(text):
+        kind = block[0]
+        if kind == "heading":
+            doc.add_heading(block[2], level=block[1])
+        elif kind == "para":
+            _add_runs(doc.add_paragraph(), block[1])
+        elif kind == "table":
+            rows = block[1]
+            cols = max(len(r) for r in rows)
+            table = doc.add_table(rows=0, cols=cols)
+            table.style = "Table Grid"
+            for r in rows:
+                cells = table.add_row().cells
+                for i, value in enumerate(r): cells[i].text = value
+
+    output = io.BytesIO()
+    doc.save(output)
+    return output.getvalue()
@@ -0,0 +1,421 @@
+import os
+import re
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from disk_cache import DiskCache, CACHE_DIR
+
+# --- 教材抽取引擎：檔案與 PDF 頁段平行處理 ---
+
+PAGES_PER_TASK = 16      # 每個子工作負責的 PDF 頁數
+FILE_TIMEOUT = 90        # 單一檔案抽取上限 (秒)，逾時的頁段會標註後略過
+MAX_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+# 抽取邏輯有變動時請遞增版本，舊快取會自然失效
+EXTRACTOR_VERSION = "1"
+TEXT_CACHE_MAX_BYTES = int(os.environ.get("QUESTWIZ_TEXT_CACHE_MB", "512")) * 1024 * 1024
+
+# 記憶體上限：單檔 / 單次上傳 (每個 session) 的大小與頁數；超出的檔案略過、頁數截斷
+MAX_FILE_BYTES = int(os.environ.get("QUESTWIZ_MAX_FILE_MB", "100")) * 1024 * 1024
+MAX_TOTAL_BYTES = int(os.environ.get("QUESTWIZ_MAX_UPLOAD_MB", "300")) * 1024 * 1024
+MAX_FILE_PAGES = int(os.environ.get("QUESTWIZ_MAX_FILE_PAGES", "1000"))
+MAX_TOTAL_PAGES = int(os.environ.get("QUESTWIZ_MAX_PAGES", "2000"))
+SPOOL_BYTES = 8 * 1024 * 1024   # 組合輸出時超過此大小改寫入暫存檔
+BLOCK_BYTES = 1 << 20           # 雜湊與寫入暫存檔時每次讀取的大小
+
+# 舊版 Word (.doc) 交給 antiword 子行程轉換；在行程池的工作中執行，同時執行數不超過 MAX_WORKERS
+DOC_TIMEOUT = 30                        # 單一檔案轉換上限 (秒)，逾時即終止 antiword
+DOC_MAX_OUTPUT = 8 * 1024 * 1024        # 轉出文字上限，超過的部分捨棄
+DOC_MAX_MEMORY = 512 * 1024 * 1024      # antiword 可用的虛擬記憶體上限
+
+PDF_FAILED_MSG = "(PDF 讀取失敗，可能是加密或純圖片)"
+DOCX_FAILED_MSG = "(DOCX 讀取失敗)"
+DOC_FAILED_MSG = "(DOC 讀取失敗，請將檔案「另存新檔」為 .docx 或 .pdf 後重新上傳)"
+DOC_TRUNCATED_MSG = "\n(文字超過上限，以下略過)"
+FILE_TOO_LARGE_MSG = "(檔案超過大小上限，已略過)"
+DOC_UNSUPPORTED_MSG = "⚠️ 系統提示：伺服器未安裝 antiword，無法讀取舊版 Word (.doc)。請將檔案「另存新檔」為 .docx 或 .pdf 後重新上傳。"
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_users = {}      # 行程池 -> 正在使用它的呼叫數
+_retired = set()      # 已卡住或損壞、不再分配的行程池，最後一個使用者結束時才終止
+_text_cache = None
+
+
+def get_text_cache():
+    """取得跨 session 共用的教材文字快取 (以檔案內容 SHA-256 為 key)"""
+    global _text_cache
+    with _pool_lock:
+        if _text_cache is None:
+            _text_cache = DiskCache(os.path.join(CACHE_DIR, "text_cache.sqlite"), TEXT_CACHE_MAX_BYTES)
+        return _text_cache
+
+
+def _get_pool():
+    """取得共用的行程池 (整個 process 只建立一次)；用完需呼叫 _release_pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Streamlit 本身是多執行緒，fork 容易卡死，改用 forkserver / spawn
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=ctx)
+        _pool_users[_pool] = _pool_users.get(_pool, 0) + 1
+        return _pool
+
+
+def _release_pool(pool, retire=False):
+    """結束使用行程池。retire 表示它已卡住或損壞：之後的呼叫改用新的行程池，
+    但要等其他 session 仍在進行的抽取都結束 (最後一個使用者) 才終止子行程"""
+    global _pool
+    with _pool_lock:
+        _pool_users[pool] -= 1
+        if retire:
+            _retired.add(pool)
+            if _pool is pool: _pool = None
+        if pool not in _retired or _pool_users[pool] > 0: return
+        _retired.discard(pool)
+        del _pool_users[pool]
+    # 逾時的子行程不會自行結束，直接終止以釋放 CPU
+    for proc in list((getattr(pool, "_processes", None) or {}).values()):
+        try: proc.terminate()
+        except Exception: pass
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+# --- 子行程工作 (必須是模組層級函式才能 pickle) ---
+
+def _open_pdf(path):
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    if reader.is_encrypted:
+        # 出版社教材多半只設擁有者密碼，空白密碼即可解開
+        reader.decrypt("")
+    return reader
+
+
+def _pdf_page_count(path):
+    return len(_open_pdf(path).pages)
+
+
+def _extract_pdf_range(path, start, end):
+    """抽取 PDF 第 start ~ end-1 頁，單頁失敗不影響其他頁"""
+    reader = _open_pdf(path)
+    segments = []
+    for i in range(start, end):
+        try:
+            content = reader.pages[i].extract_text() or ""
+        except Exception:
+            content = "(本頁讀取失敗)"
+        segments.append(f"\n--- Page {i+1} ---\n{content}")
+    return segments
+
+
+def _extract_docx(path):
+    from docx import Document
+    doc = Document(path)
+    return ["\n".join([p.text for p in doc.paragraphs])]
+
+
+def _antiword_command(path):
+    # 經由 sh 的 ulimit 限制 CPU 秒數與記憶體，避免損壞的檔案拖垮主機。
+    # 不用 preexec_fn：單一檔案會在 Streamlit 的多執行緒行程中直接執行，fork 後跑 Python 可能死結
+    command = ["antiword", "-m", "UTF-8.txt", "-w", "0", path]
+    if os.name != "posix": return command
+    # dash 的 ulimit 一次只接受一個資源，需分開設定；主機原有的上限更低時沿用原上限
+    limits = f"ulimit -t {DOC_TIMEOUT} 2>/dev/null; ulimit -v {DOC_MAX_MEMORY // 1024} 2>/dev/null"
+    return ["sh", "-c", f'{limits}; exec "$@"', "antiword"] + command
+
+
+def _extract_doc(path):
+    """以 antiword 轉出舊版 Word 文字；逾時即終止，輸出超過 DOC_MAX_OUTPUT 的部分捨棄"""
+    env = {"PATH": os.environ.get("PATH", ""), "LANG": "C.UTF-8"}
+    if "ANTIWORDHOME" in os.environ: env["ANTIWORDHOME"] = os.environ["ANTIWORDHOME"]
+    proc = subprocess.Popen(
+        _antiword_command(path),
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        cwd=os.path.dirname(path) or None, env=env,
+        start_new_session=os.name == "posix"
+    )
+
+    def kill():
+        # 獨立的行程群組：連同 antiword 衍生的子行程一起終止，輸出管線才會關閉
+        try: os.killpg(proc.pid, 9) if os.name == "posix" else proc.kill()
+        except OSError: pass
+
+    timed_out = []
+    watchdog = threading.Timer(DOC_TIMEOUT, lambda: (timed_out.append(True), kill()))
+    watchdog.start()
+    chunks, size, truncated = [], 0, False
+    try:
+        for block in iter(lambda: proc.stdout.read(BLOCK_BYTES), b""):
+            if size + len(block) > DOC_MAX_OUTPUT:
+                chunks.append(block[:DOC_MAX_OUTPUT - size])
+                truncated = True
+                kill()
+                break
+            chunks.append(block)
+            size += len(block)
+        proc.wait()
+    finally:
+        watchdog.cancel()
+        proc.stdout.close()
+    # 不可用 TimeoutError：它與 concurrent.futures 的逾時是同一類別，會被誤判為行程池卡住
+    if timed_out: raise RuntimeError(f"antiword 逾時 {DOC_TIMEOUT} 秒")
+    if proc.returncode != 0 and not truncated: raise RuntimeError(f"antiword 結束碼 {proc.returncode}")
+    text = b"".join(chunks).decode("utf-8", errors="replace")
+    return [text + DOC_TRUNCATED_MSG if truncated else text]
+
+
+# --- 主流程 ---
+
+class _FileJob:
+    """單一上傳檔案的抽取計畫與結果"""
+
+    def __init__(self, name):
+        self.name = name
+        self.tasks = []        # [(func, args, 失敗時的替代片段)]
+        self.futures = []
+        self.segments = []
+        self.text = None       # 直接給定的結果 (錯誤訊息或不支援格式)
+        self.error = None      # 規劃階段就失敗的例外訊息
+        self.failed_msg = DOCX_FAILED_MSG   # 整檔抽取失敗時的替代文字
+        self.cache_key = None
+        self.failed = False    # 有任何頁段失敗或逾時就不寫入快取
+        self.note = None       # 頁數超過上限時附在檔案末尾的說明 (截斷的結果不寫入快取)
+
+
+def _file_name(file):
+    if isinstance(file, (str, os.PathLike)): return os.path.basename(os.fspath(file))
+    return file.name
+
+
+def _file_size(file):
+    if isinstance(file, (str, os.PathLike)): return os.path.getsize(file)
+    size = getattr(file, "size", None)   # Streamlit UploadedFile
+    if size is not None: return size
+    if hasattr(file, "getbuffer"):
+        with file.getbuffer() as buf: return buf.nbytes
+    return len(file.getvalue())
+
+
+def check_upload_limits(files):
+    """檢查單檔與合計大小，回傳錯誤訊息列表 (空列表表示通過)"""
+    problems = []
+    total = 0
+    for file in files:
+        size = _file_size(file)
+        total += size
+        if size > MAX_FILE_BYTES:
+            problems.append(f"{_file_name(file)} 為 {size / 1048576:.1f} MB，超過單檔上限 {MAX_FILE_BYTES // 1048576} MB")
+    if total > MAX_TOTAL_BYTES:
+        problems.append(f"檔案合計 {total / 1048576:.1f} MB，超過單次上傳上限 {MAX_TOTAL_BYTES // 1048576} MB")
+    return problems
+
+
+def _blocks(file):
+    if hasattr(file, "seek"): file.seek(0)
+    return iter(lambda: file.read(BLOCK_BYTES), b"")
+
+
+def _fingerprint(file):
+    """逐塊計算檔案內容 SHA-256，不把整個上傳檔複製一份"""
+    digest = hashlib.sha256()
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(BLOCK_BYTES), b""): digest.update(block)
+        return digest.hexdigest()
+    for block in _blocks(file): digest.update(block)
+    return digest.hexdigest()
+
+
+def _spill_to_disk(file, tmpdir, index):
+    """將上傳檔逐塊寫入暫存檔，讓子行程以路徑逐頁讀取 (避免大檔反覆 pickle)"""
+    if isinstance(file, (str, os.PathLike)): return os.fspath(file)
+    path = os.path.join(tmpdir, f"{index}")
+    with open(path, "wb") as f:
+        for block in _blocks(file): f.write(block)
+    return path
+
+
+def _limit_pages(job, total, budget):
+    """依單檔與剩餘頁數額度決定要抽取幾頁，超出時記下說明"""
+    allowed = max(0, min(total, MAX_FILE_PAGES, budget["pages"]))
+    budget["pages"] -= allowed
+    if allowed < total:
+        job.note = f"\n(超過頁數上限，僅抽取前 {allowed} 頁，共 {total} 頁)"
+        metrics.inc("extract_truncated_files")
+    return allowed
+
+
+def _cache_key(ext, digest):
+    return f"text:{EXTRACTOR_VERSION}:{ext}:{digest}"
+
+
+def _plan_file(file, index, tmpdir, cache, budget):
+    """budget 為本次呼叫剩餘的 {"bytes", "pages"} 額度，所有檔案共用"""
+    job = _FileJob(_file_name(file))
+    ext = job.name.split('.')[-1].lower()
+    if ext == 'doc' and shutil.which("antiword") is None:
+        job.text = DOC_UNSUPPORTED_MSG
+        return job
+    if ext in ('pdf', 'docx', 'doc'):
+        size = _file_size(file)
+        if size > MAX_FILE_BYTES or size > budget["bytes"]:
+            metrics.inc("extract_rejected_files")
+            job.text = FILE_TOO_LARGE_MSG
+            return job
+        budget["bytes"] -= size
+        digest = _fingerprint(file)
+        if cache is not None:
+            job.cache_key = _cache_key(ext, digest)
+            cached = cache.get(job.cache_key)
+            if cached is not None:
+                metrics.inc("text_cache_hits")
+                # PDF 快取為逐頁片段，同樣受頁數額度限制
+                job.segments = cached[:_limit_pages(job, len(cached), budget)] if ext == 'pdf' else cached
+                return job
+            metrics.inc("text_cache_misses")
+        path = _spill_to_disk(file, tmpdir, index)
+    if ext == 'pdf':
+        try:
+            total = _limit_pages(job, _pdf_page_count(path), budget)
+        except Exception:
+            job.text = PDF_FAILED_MSG
+            return job
+        for start in range(0, total, PAGES_PER_TASK):
+            end = min(start + PAGES_PER_TASK, total)
+            fallback = [f"\n--- Page {i+1} ---\n(本頁讀取失敗)" for i in range(start, end)]
+            job.tasks.append((_extract_pdf_range, (path, start, end), fallback))
+    elif ext == 'docx':
+        job.tasks.append((_extract_docx, (path,), None))
+    elif ext == 'doc':
+        # 與其他檔案的頁段一起送進行程池，轉換結果同樣依內容雜湊快取
+        job.failed_msg = DOC_FAILED_MSG
+        job.tasks.append((_extract_doc, (path,), None))
+    else:
+        job.text = ""
+    return job
+
+
+def _run_inline(job):
+    for func, args, fallback in job.tasks:
+        try:
+            job.segments.extend(func(*args))
+        except Exception:
+            job.failed = True
+            if fallback is None:
+                job.text = job.failed_msg
+                return
+            job.segments.extend(fallback)
+
+
+def _collect(job, pool, timeout):
+    """依序收回單一檔案的所有頁段；回傳 True 表示行程池需要重建"""
+    deadline = time.monotonic() + timeout
+    broken = False
+    for (_, args, fallback), fut in zip(job.tasks, job.futures):
+        try:
+            job.segments.extend(fut.result(timeout=max(0.0, deadline - time.monotonic())))
+        except FutureTimeout:
+            broken = job.failed = True
+            metrics.inc("extract_timeouts")
+            if fallback is None:
+                job.text = f"(檔案抽取逾時 {timeout} 秒，已略過)"
+                return broken
+            start, end = args[1], args[2]
+            job.segments.append(f"\n--- Page {start+1}-{end} ---\n(抽取逾時，已略過)")
+        except BrokenProcessPool:
+            # 子行程異常終止 (例如記憶體不足被砍)：不在本行程重試，同樣的內容可能拖垮整個伺服器
+            broken = job.failed = True
+            metrics.inc("extract_worker_crashes")
+            if fallback is None:
+                job.text = job.failed_msg
+                return broken
+            job.segments.extend(fallback)
+        except Exception:
+            job.failed = True
+            if fallback is None:
+                job.text = job.failed_msg
+                return broken
+            job.segments.extend(fallback)
+    return broken
+
+
+def _format_file(job):
+    if job.error is not None:
+        return f"\n[讀取錯誤: {job.name} - {job.error}]"
+    file_text = job.text if job.text is not None else "".join(job.segments)
+    if job.note and job.text is None: file_text += job.note
+    # 簡單清洗
+    file_text = re.sub(r'\n\s*\n', '\n\n', file_text)
+    return f"\n\n=== 檔案: {job.name} ===\n{file_text}"
+
+
+def _store(job, cache):
+    """完整抽取成功的檔案寫入快取 (逐頁片段，壓縮保存)"""
+    if cache is None or job.cache_key is None or job.failed or job.note or job.text is not None: return
+    if job.tasks: cache.set(job.cache_key, job.segments)
+
+
+def extract_text_from_files(files, timeout=FILE_TIMEOUT, use_cache=True):
+    """平行抽取所有檔案文字，依上傳順序與頁碼重組輸出；相同內容的檔案直接取自磁碟快取。
+    超過大小上限的檔案略過、超過頁數上限的部分不抽取；各檔結果寫入暫存檔後立即釋放"""
+    started = time.perf_counter()
+    budget = {"bytes": MAX_TOTAL_BYTES, "pages": MAX_TOTAL_PAGES}
+    cache = None
+    if use_cache:
+        try: cache = get_text_cache()
+        except Exception: cache = None   # 快取目錄不可寫時照常抽取
+    with tempfile.TemporaryDirectory(prefix="questwiz-") as tmpdir, \
+         tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES, mode="w+", encoding="utf-8", dir=tmpdir) as out:
+        jobs = []
+        for i, file in enumerate(files):
+            try:
+                jobs.append(_plan_file(file, i, tmpdir, cache, budget))
+            except Exception as e:
+                job = _FileJob(_file_name(file))
+                job.error = str(e)
+                jobs.append(job)
+
+        total_tasks = sum(len(job.tasks) for job in jobs)
+        pool = None
+        # 共用的行程池可能剛被其他 session 的工作弄壞：換一個新的再試一次
+        for attempt in range(2 if total_tasks > 1 else 0):
+            try:
+                pool = _get_pool()
+                for job in jobs:
+                    job.futures = [pool.submit(func, *args) for func, args, _ in job.tasks]
+                break
+            except Exception:
+                if pool is not None: _release_pool(pool, retire=True)
+                pool = None
+                for job in jobs: job.futures = []
+        # 仍無法使用行程池 (例如受限環境)：退回單行程逐一處理
+
+        needs_reset = False
+        try:
+            for job in jobs:
+                if job.futures:
+                    needs_reset = _collect(job, pool, timeout) or needs_reset
+                elif job.tasks:
+                    _run_inline(job)
+                _store(job, cache)
+                out.write(_format_file(job))
+                # 頁段結果已寫出，不再留在記憶體
+                job.segments, job.futures = [], []
+        finally:
+            if pool is not None: _release_pool(pool, retire=needs_reset)
+        out.seek(0)
+        text_content = out.read()
+    metrics.inc("extract_files", len(files))
+    metrics.observe("extract_seconds", time.perf_counter() - started)
+    return text_content
@@ -0,0 +1,334 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from disk_cache import CACHE_DIR
+from scheduler import request_context, check_cancelled, Cancelled, PHASE3, SPECULATIVE
+
+# --- 背景命題工作：在獨立的執行緒池中執行，不受 Streamlit 重跑、重新整理或斷線影響 ---
+#
+# 每個工作有一個 id，狀態與進度寫入 JOBS_DIR/{id}.json；介面只負責附掛並顯示進度，
+# 重新整理後可依網址上的 ?job=id 重新附掛。行程重啟時未完成的工作標記為 interrupted。
+# 推測性工作 (審核表總分達 100 時預先命題) 會延遲 SPECULATIVE_DELAY 秒才開始，期間表格再被修改就直接取消；
+# 已開始的則在下一個模型請求或串流片段前停止。每個 session 同時只有一個推測性工作，
+# 其請求排在所有正式命題之後，轉為正式工作時才提升優先序。
+
+JOBS_DIR = os.environ.get("QUESTWIZ_JOBS_DIR", os.path.join(CACHE_DIR, "jobs"))
+JOB_WORKERS = int(os.environ.get("QUESTWIZ_JOB_WORKERS", "8"))
+JOB_TTL = 24 * 3600       # 工作檔保留秒數
+SPECULATIVE_DELAY = 5     # 推測性工作的等待秒數
+SAVE_INTERVAL = 1.0       # 串流中進度寫檔的最短間隔 (秒)
+MAX_MEMORY_JOBS = 200     # 記憶體中保留的已結束工作數，其餘需要時再由檔案讀回
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+INTERRUPTED = "interrupted"
+FINISHED = (DONE, FAILED, CANCELLED, INTERRUPTED)
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+class Job:
+    """一個背景工作的狀態；progress / result 必須可轉為 JSON"""
+
+    def __init__(self, job_id, session, kind, fingerprint, inputs, speculative=False):
+        self.id = job_id
+        self.session = session
+        self.kind = kind
+        self.fingerprint = fingerprint
+        self.inputs = inputs
+        self.speculative = speculative
+        self.status = QUEUED
+        self.created = self.updated = time.time()
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.cancel_requested = False
+        self._timer = None
+        self._work = None
+        self._request = None   # 執行中的 RequestContext，用來調整優先序或取消
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in (
+            "id", "session", "kind", "fingerprint", "inputs", "speculative",
+            "status", "created", "updated", "progress", "result", "error")}
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data["id"], data.get("session"), data.get("kind"), data.get("fingerprint"),
+                  data.get("inputs") or {}, data.get("speculative", False))
+        for key in ("status", "created", "updated", "progress", "result", "error"):
+            if key in data: setattr(job, key, data[key])
+        return job
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+
+class JobManager:
+    """行程內共用的背景工作管理"""
+
+    def __init__(self, directory=JOBS_DIR, max_workers=JOB_WORKERS):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._last_save = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="questwiz-job")
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _recover(self):
+        """清除過期的工作檔；上次行程結束時仍在執行的工作標記為中斷"""
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"): continue
+            try:
+                if now - entry.stat().st_mtime > JOB_TTL:
+                    os.remove(entry.path)
+                    continue
+                with open(entry.path, encoding="utf-8") as f:
+                    job = Job.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError):
+                continue
+            if not job.finished:
+                job.status = INTERRUPTED
+                job.error = "伺服器重新啟動，工作已中斷"
+                self._save(job)
+
+    def _save(self, job):
+        # 先寫暫存檔再取代，讀取端不會看到半份 JSON；寫檔失敗不影響工作本身
+        job.updated = time.time()
+        path = self._path(job.id)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(job.to_dict(), f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError):
+            pass
+        self._last_save[job.id] = time.monotonic()
+
+    def _prune(self):
+        finished = sorted((j for j in self._jobs.values() if j.finished), key=lambda j: j.updated)
+        for job in finished[:max(0, len(finished) - MAX_MEMORY_JOBS)]:
+            self._jobs.pop(job.id, None)
+            self._last_save.pop(job.id, None)
+
+    def submit(self, session, kind, fingerprint, inputs, work, speculative=False):
+        """送出工作；work(job) 的回傳值 (可轉為 JSON) 即為結果。推測性工作延遲 SPECULATIVE_DELAY 秒才開始"""
+        job = Job(uuid.uuid4().hex, session, kind, fingerprint, inputs, speculative)
+        job._work = work
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            # 推測性工作開始執行時才寫檔，在延遲期間就作廢的不留任何痕跡
+            if not speculative: self._save(job)
+            if speculative:
+                job._timer = threading.Timer(SPECULATIVE_DELAY, self._dispatch, args=(job,))
+                job._timer.daemon = True
+                job._timer.start()
+            else:
+                self._dispatch_locked(job)
+        return job
+
+    def _dispatch(self, job):
+        with self._lock:
+            self._dispatch_locked(job)
+
+    def _dispatch_locked(self, job):
+        if job._timer is not None:
+            job._timer.cancel()
+            job._timer = None
+        if job.status != QUEUED or job._work is None: return
+        work, job._work = job._work, None
+        self._executor.submit(self._run, job, work)
+
+    def _run(self, job, work):
+        with self._lock:
+            if job.status != QUEUED: return
+            job.status = RUNNING
+            self._save(job)
+        try:
+            result = work(job)
+        except Cancelled:
+            with self._lock:
+                job.status = CANCELLED
+                if job.id in self._last_save: self._save(job)
+            return
+        except Exception as e:
+            with self._lock:
+                job.status, job.error = FAILED, str(e) or type(e).__name__
+                self._save(job)
+            return
+        with self._lock:
+            job.status, job.result = DONE, result
+            self._save(job)
+
+    def due(self, job):
+        """距上次寫檔是否已超過 SAVE_INTERVAL；串流等頻繁的進度先自行累積，到期才交給 update"""
+        return time.monotonic() - self._last_save.get(job.id, 0) >= SAVE_INTERVAL
+
+    def update(self, job, force=False, **progress):
+        """由工作本身回報進度；串流等頻繁更新時每 SAVE_INTERVAL 秒才寫檔一次"""
+        with self._lock:
+            job.progress.update(progress)
+            job.updated = time.time()
+            if force or self.due(job): self._save(job)
+
+    def get(self, job_id):
+        """依 id 取得工作；不在記憶體中時由工作檔讀回 (例如行程重啟後)"""
+        if not job_id or not all(c in "0123456789abcdef" for c in job_id): return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None: return job
+            try:
+                with open(self._path(job_id), encoding="utf-8") as f:
+                    job = Job.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError):
+                return None
+            self._jobs[job.id] = job
+            return job
+
+    def snapshot(self, job):
+        """介面輪詢用的狀態複本 (不含 inputs)。進度的各值更新時整個替換、不會原地修改，淺複製即可"""
+        with self._lock:
+            return {"status": job.status, "progress": dict(job.progress), "error": job.error, "result": job.result}
+
+    def find(self, session, fingerprint):
+        """同一 session 中輸入相同、尚未失敗或取消的最新工作"""
+        with self._lock:
+            matches = [j for j in self._jobs.values()
+                       if j.session == session and j.fingerprint == fingerprint
+                       and j.status in (QUEUED, RUNNING, DONE) and not j.cancel_requested]
+            return max(matches, key=lambda j: j.created) if matches else None
+
+    def promote(self, job):
+        """推測性工作轉為正式工作：不再等待延遲，立即開始；已在執行的改以正式命題的優先序排程"""
+        with self._lock:
+            job.speculative = False
+            if job._request is not None: job._request.priority = PHASE3
+            self._dispatch_locked(job)
+
+    @contextmanager
+    def requests(self, job, on_wait=None):
+        """工作送出模型請求時所在的 request_context：推測性工作以較低的優先序排程，並可在途中取消"""
+        with request_context(job.session, PHASE3, on_wait) as request:
+            with self._lock:
+                request.priority = SPECULATIVE if job.speculative else PHASE3
+                request.cancelled = job.cancel_requested
+                job._request = request
+            try:
+                yield request
+            finally:
+                with self._lock: job._request = None
+
+    def cancel(self, job):
+        """取消工作：尚未開始的直接取消；執行中的推測性工作在下一個模型請求或串流片段前停止。
+        執行中的正式工作會跑完，結果仍可重用"""
+        with self._lock:
+            if job.status == RUNNING and job.speculative:
+                job.cancel_requested = True
+                if job._request is not None: job._request.cancelled = True
+                return True
+            if job.status != QUEUED: return False
+            if job._timer is not None: job._timer.cancel()
+            job._timer = job._work = None
+            job.status = CANCELLED
+            if job.id in self._last_save: self._save(job)
+            return True
+
+    def cancel_speculative(self, session, keep=None):
+        """取消此 session 其他的推測性工作 (審核表又被修改時)，含已在執行的；每個 session 因此最多只有一個"""
+        with self._lock:
+            pending = [j for j in self._jobs.values()
+                       if j.session == session and j.speculative and j.status in (QUEUED, RUNNING)
+                       and not j.cancel_requested and j is not keep]
+        for job in pending: self.cancel(job)
+
+
+def get_job_manager():
+    """取得跨 session 共用的背景工作管理"""
+    global _manager
+    with _manager_lock:
+        if _manager is None: _manager = JobManager()
+        return _manager
+
+
+def phase3_work(manager, df, grade, subject, mode, pool, keys, catalog=None, force_fresh=False, sectioned=True,
+                bank=None, reuse_ratio=0.0, material=None, last_exam=None):
+    """建立 Phase 3 命題工作。進度：model、carried (沿用上一版的列數)、sections (各大題標題)、
+    texts (已完成的大題文字) 或 text (串流中的整份試卷)、queue (排程器的排隊狀態)、cached；
+    結果：{"text": 試卷, "warnings": [配分警告]}"""
+    from llm import get_best_model
+    from pipeline import generate_exam_sections, generate_exam_stream, carry_over
+    from retrieval import get_index
+    from sections import plan_sections
+
+    def prepare(job):
+        # 模型查詢、教材索引與上一版比對都在工作開始後才做，延遲期間就作廢的推測性工作不花任何成本
+        model_name, error_msg = get_best_model(pool.best_key(keys), mode="smart", catalog=catalog)
+        if error_msg: raise RuntimeError(error_msg)
+        # 教材檢索索引依內容雜湊快取，同一份教材只建一次
+        index = get_index(material.read()) if material is not None else None
+        # 與上一版比對：內容未變的列沿用原試題
+        carried = None
+        if last_exam and last_exam["meta"] == (grade, subject, mode):
+            try: carried = carry_over(df, last_exam["df"], last_exam["text"], grade, subject, mode)
+            except Exception: carried = None   # 比對失敗就整份重新命題
+        kept = sum(len(positions) for positions, _ in carried.values()) if carried else 0
+        if kept: metrics.inc("phase3_rows_carried", kept)
+        manager.update(job, force=True, model=model_name, carried=kept)
+        return model_name, index, carried
+
+    def work(job):
+        if job.cancel_requested: raise Cancelled("工作已取消")
+        model_name, index, carried = prepare(job)
+        on_wait = lambda status: manager.update(job, queue=status)
+        path = "sections" if sectioned or carried else "stream"
+        with manager.requests(job, on_wait), metrics.span("phase3", model=model_name, path=path):
+            if path == "sections":
+                sections = plan_sections(df)
+                texts = [None] * len(sections)
+                manager.update(job, force=True, sections=[s.title for s in sections], texts=texts)
+
+                def on_section(section, text):
+                    texts[section.index] = text
+                    manager.update(job, force=True, texts=list(texts))
+
+                exam_text, warnings = generate_exam_sections(
+                    df, grade, subject, mode, model_name, pool=pool, keys=keys, force_fresh=force_fresh,
+                    on_section=on_section, bank=bank, reuse_ratio=reuse_ratio, index=index, reuse=carried or None
+                )
+                return {"text": exam_text, "warnings": warnings}
+
+            parts = []
+
+            def on_text(text):
+                # 每個 chunk 只累積；到了寫檔時間才組成全文發佈，避免每個 chunk 都重組整份試卷
+                check_cancelled()
+                parts.append(text)
+                if manager.due(job): manager.update(job, text="".join(parts))
+
+            exam_text, cached = generate_exam_stream(df, grade, subject, mode, model_name, pool=pool, keys=keys,
+                                                     force_fresh=force_fresh, index=index, on_text=on_text)
+            manager.update(job, force=True, text=exam_text, cached=cached)
+            if bank is not None:
+                # 試題存入題庫供日後重用；存檔失敗不影響本次結果
+                try: bank.store_exam(exam_text, df, grade, subject, mode)
+                except Exception: pass
+            return {"text": exam_text, "warnings": []}
+
+    return work
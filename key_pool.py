@@ -0,0 +1,163 @@
+import os
+import time
+import random
+import threading
+from collections import deque
+
+# --- API Key 池：每把 key 的令牌桶、錯誤率與冷卻狀態 (整個 process 共用) ---
+
+DEFAULT_RPM = int(os.environ.get("QUESTWIZ_KEY_RPM", "10"))   # 每把 key 每分鐘請求上限
+ERROR_WINDOW = 300        # 錯誤率統計視窗 (秒)
+COOLDOWN_BASE = 15        # 429 後的基本冷卻秒數，連續失敗時加倍
+COOLDOWN_MAX = 300
+DISABLE_SECONDS = 3600    # key 無效 / 無權限時停用的時間
+
+# 錯誤分類
+RETRYABLE = "retryable"          # 網路、5xx、逾時：退避後重試
+RATE_LIMITED = "rate_limited"    # 429 / 配額用盡：此 key 冷卻，立即改用其他 key
+KEY_FATAL = "key_fatal"          # key 無效或無權限：停用此 key，改用其他 key
+FATAL = "fatal"                  # 請求本身有問題 (參數、模型不存在、內容封鎖)：不重試
+
+
+class NoKeyAvailable(Exception):
+    """所有 key 都在冷卻或已停用"""
+
+
+def classify_error(exc):
+    """將 Gemini / 網路例外分類為 RETRYABLE、RATE_LIMITED、KEY_FATAL 或 FATAL"""
+    name = type(exc).__name__
+    code = getattr(exc, "code", None)
+    msg = str(exc).lower()
+    if name in ("ResourceExhausted", "TooManyRequests") or code == 429 or "quota" in msg:
+        return RATE_LIMITED
+    if "api key not valid" in msg or "api_key_invalid" in msg:
+        return KEY_FATAL
+    if name in ("PermissionDenied", "Unauthenticated", "Unauthorized", "Forbidden") or code in (401, 403):
+        return KEY_FATAL
+    if name in ("InvalidArgument", "NotFound", "FailedPrecondition", "BadRequest",
+                "BlockedPromptException", "StopCandidateException") or code in (400, 404):
+        return FATAL
+    return RETRYABLE
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """指數退避加上完整抖動 (full jitter)，避免多個 session 同時重試"""
+    return random.uniform(base / 2, min(cap, base * (2 ** attempt)))
+
+
+def mask_key(key):
+    return f"{key[:4]}…{key[-4:]}" if len(key) > 8 else "****"
+
+
+class _KeyState:
+    def __init__(self, rpm):
+        self.capacity = max(1, rpm)
+        self.tokens = float(self.capacity)
+        self.refill_rate = rpm / 60.0
+        self.last_refill = time.monotonic()
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.recent = deque(maxlen=100)   # [(時間, 是否成功)]
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    def error_rate(self, now):
+        recent = [ok for t, ok in self.recent if now - t <= ERROR_WINDOW]
+        if not recent: return 0.0
+        return 1.0 - sum(recent) / len(recent)
+
+    def ready_at(self, now):
+        """此 key 最快何時可再送出請求"""
+        wait_tokens = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.refill_rate
+        return max(self.cooldown_until, now + wait_tokens)
+
+
+class KeyPool:
+    """依健康度挑選 key，並在 429 / 無效 key 時於請求途中切換"""
+
+    def __init__(self, rpm=DEFAULT_RPM):
+        self.rpm = rpm
+        self._states = {}
+        self._cond = threading.Condition()
+
+    def _state(self, key):
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _KeyState(self.rpm)
+        return state
+
+    def _pick(self, keys, exclude, now):
+        candidates = []
+        for key in keys:
+            state = self._state(key)
+            state.refill(now)
+            if state.cooldown_until > now or state.tokens < 1: continue
+            candidates.append(key)
+        # 本次請求已失敗過的 key 只在別無選擇時使用
+        fresh = [k for k in candidates if k not in exclude] or candidates
+        if not fresh: return None
+        return min(fresh, key=lambda k: (self._states[k].error_rate(now), -self._states[k].tokens, random.random()))
+
+    def acquire(self, keys, exclude=(), timeout=60):
+        """取得目前最健康且有額度的 key (會消耗一個令牌)；必要時等待"""
+        keys = list(dict.fromkeys(keys))
+        if not keys: raise NoKeyAvailable("未提供 API Key")
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                key = self._pick(keys, exclude, now)
+                if key is not None:
+                    self._states[key].tokens -= 1
+                    return key
+                ready = min(self._state(k).ready_at(now) for k in keys)
+                if ready - now > DISABLE_SECONDS / 2 or ready > deadline:
+                    raise NoKeyAvailable("所有 API Key 皆在冷卻中或已失效，請稍後再試或更換金鑰")
+                self._cond.wait(timeout=max(0.05, ready - now))
+
+    def best_key(self, keys):
+        """挑選目前最健康的 key (不消耗令牌)，用於模型查詢等輕量操作"""
+        with self._cond:
+            now = time.monotonic()
+            usable = [k for k in keys if self._state(k).cooldown_until <= now] or list(keys)
+            return min(usable, key=lambda k: (self._states[k].error_rate(now), random.random()))
+
+    def report_success(self, key):
+        with self._cond:
+            state = self._state(key)
+            state.recent.append((time.monotonic(), True))
+            state.consecutive_failures = 0
+            self._cond.notify_all()
+
+    def report_failure(self, key, kind):
+        with self._cond:
+            state = self._state(key)
+            now = time.monotonic()
+            state.recent.append((now, False))
+            state.consecutive_failures += 1
+            if kind == RATE_LIMITED:
+                cooldown = min(COOLDOWN_MAX, COOLDOWN_BASE * (2 ** (state.consecutive_failures - 1)))
+                state.cooldown_until = now + random.uniform(0.8, 1.2) * cooldown
+                state.tokens = 0.0
+            elif kind == KEY_FATAL:
+                state.cooldown_until = now + DISABLE_SECONDS
+            elif kind == RETRYABLE and state.consecutive_failures >= 3:
+                state.cooldown_until = now + COOLDOWN_BASE
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """各 key 狀態摘要 (key 已遮罩)，供介面顯示"""
+        with self._cond:
+            now = time.monotonic()
+            rows = []
+            for key, state in self._states.items():
+                state.refill(now)
+                rows.append({
+                    "key": mask_key(key),
+                    "tokens": round(state.tokens, 1),
+                    "error_rate": round(state.error_rate(now), 2),
+                    "cooldown": max(0, round(state.cooldown_until - now)),
+                })
+            return rows
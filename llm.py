@@ -0,0 +1,330 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+import scheduler
+from disk_cache import DiskCache, CACHE_DIR
+from key_pool import classify_error, backoff_delay, mask_key, FATAL, RATE_LIMITED, KEY_FATAL
+
+# --- Gemini 呼叫工具：模型搜尋、key 綁定、重試與回應快取 ---
+
+MAX_RETRIES = 4
+RESPONSE_CACHE_TTL = int(os.environ.get("QUESTWIZ_RESPONSE_TTL_HOURS", "168")) * 3600
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("QUESTWIZ_RESPONSE_CACHE_MB", "256")) * 1024 * 1024
+REPLAY_CHUNK_CHARS = 120   # 快取重播時每段的字數
+MAX_CLIENTS = 64           # 保留幾把 key 的 client (LRU)
+MAX_CATALOG_ENTRIES = 256  # 模型清單最多快取幾把 key
+
+_configure_lock = threading.Lock()
+_clients = OrderedDict()
+_response_cache = None
+
+
+def list_generation_models(api_key):
+    """查詢此 key 可用於 generateContent 的模型名稱 (網路請求)"""
+    import google.generativeai as genai
+    # genai.configure 是全域設定，多個 session 同時查詢時需互斥
+    with _configure_lock:
+        genai.configure(api_key=api_key)
+        return [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
+
+
+class ModelCatalog:
+    """依 key 快取模型清單 (有存活時間、最多 max_entries 把 key)，查詢失敗不快取"""
+
+    def __init__(self, ttl=3600, max_entries=MAX_CATALOG_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def models(self, api_key):
+        key = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                metrics.inc("model_catalog_hits")
+                return entry[1]
+        with metrics.span("model_discovery"):
+            models = list_generation_models(api_key)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), models)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+        return models
+
+
+_default_catalog = ModelCatalog()
+
+
+# --- 智能模型設定 (解決 404 與連線問題) ---
+def get_best_model(api_key, mode="fast", catalog=None):
+    try:
+        # 1. 獲取所有可用模型清單 (同一把 key 在存活時間內只查一次)
+        models = (catalog or _default_catalog).models(api_key)
+        if not models: return None, "找不到可用模型，請檢查 API Key 權限"
+        
+        target_model = None
+        
+        # 2. 搜尋邏輯
+        if mode == "fast":
+            # 優先找含有 flash 的模型
+            for m in models:
+                if 'flash' in m.lower(): target_model = m; break
+            if not target_model: target_model = models[0]
+            
+        elif mode == "smart":
+            # 優先找含有 pro 的模型
+            for m in models:
+                if 'pro' in m.lower() and '1.5' in m.lower(): target_model = m; break
+            if not target_model:
+                for m in models:
+                    if 'pro' in m.lower(): target_model = m; break
+            if not target_model: target_model = models[0]
+            
+        return target_model, None
+    except Exception as e: return None, str(e)
+
+
+def new_model(**kwargs):
+    """建立 GenerativeModel (延遲載入 google.generativeai)"""
+    import google.generativeai as genai
+    return genai.GenerativeModel(**kwargs)
+
+
+def _generative_client(api_key):
+    """每把 key 各自一個 GenerativeService client，避免改動全域設定；最多保留 MAX_CLIENTS 個 (LRU)"""
+    with _configure_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            from google.ai import generativelanguage as glm
+            client = _clients[api_key] = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+            while len(_clients) > MAX_CLIENTS: _clients.popitem(last=False)
+        _clients.move_to_end(api_key)
+        return client
+
+
+def bind_key(model_or_chat, api_key):
+    """讓 GenerativeModel / ChatSession 之後的請求改用指定 key"""
+    model = getattr(model_or_chat, "model", model_or_chat)
+    model._client = _generative_client(api_key)
+
+
+def _model_name(model_or_chat):
+    model = getattr(model_or_chat, "model", model_or_chat)
+    return getattr(model, "model_name", None) or "unknown"
+
+
+def _send(model_or_chat, prompt, stream):
+    if hasattr(model_or_chat, 'send_message'):
+        return model_or_chat.send_message(prompt, stream=stream)
+    return model_or_chat.generate_content(prompt, stream=stream)
+
+
+def _timed_send(model_or_chat, prompt, stream, model, key=None):
+    # 串流時只計到收到回應物件為止 (首個 chunk 另由 _MeteredStream 記錄)
+    started = time.perf_counter()
+    try:
+        return _send(model_or_chat, prompt, stream)
+    except Exception as e:
+        metrics.inc("gemini_errors", model=model, key=key and mask_key(key), kind=classify_error(e))
+        raise
+    finally:
+        metrics.observe("gemini_request_seconds", time.perf_counter() - started, model=model, key=key and mask_key(key))
+
+
+def _generate(model_or_chat, prompt, stream, pool, keys):
+    """回傳 (回應, 使用的 key)"""
+    model = _model_name(model_or_chat)
+    if pool is None or not keys:
+        for i in range(MAX_RETRIES):
+            try:
+                return _timed_send(model_or_chat, prompt, stream, model), None
+            except Exception as e:
+                if classify_error(e) == FATAL or i == MAX_RETRIES - 1: raise
+                metrics.inc("gemini_retries", model=model)
+                time.sleep(backoff_delay(i))
+        raise Exception("連線逾時，請檢查網路")
+
+    tried = set()
+    last_error = None
+    for i in range(MAX_RETRIES):
+        key = pool.acquire(keys, exclude=tried)
+        bind_key(model_or_chat, key)
+        try:
+            response = _timed_send(model_or_chat, prompt, stream, model, key)
+        except Exception as e:
+            kind = classify_error(e)
+            pool.report_failure(key, kind)
+            if kind == FATAL: raise
+            tried.add(key)
+            last_error = e
+            metrics.inc("gemini_retries", model=model)
+            # 還有沒試過的 key 就直接切換；全部試過或只是暫時性錯誤才退避等待
+            if kind not in (RATE_LIMITED, KEY_FATAL) or tried.issuperset(keys):
+                time.sleep(backoff_delay(i))
+            continue
+        pool.report_success(key)
+        return response, key
+    raise last_error or Exception("連線逾時，請檢查網路")
+
+
+# --- 回應快取：相同模型、系統指令、生成參數與 prompt 直接重用先前的輸出 ---
+
+def get_response_cache():
+    global _response_cache
+    with _configure_lock:
+        if _response_cache is None:
+            _response_cache = DiskCache(
+                os.path.join(CACHE_DIR, "response_cache.sqlite"), RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL
+            )
+        return _response_cache
+
+
+def response_cache_key(model_name, system_instruction, generation_config, prompt):
+    payload = json.dumps([model_name, system_instruction, generation_config or {}, prompt], ensure_ascii=False, sort_keys=True)
+    return "resp:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class CachedResponse:
+    """快取命中的回應：提供 .text，也能像串流一樣逐段迭代"""
+
+    cached = True
+
+    def __init__(self, text):
+        self.text = text
+
+    def __iter__(self):
+        for i in range(0, len(self.text), REPLAY_CHUNK_CHARS):
+            yield _Chunk(self.text[i:i + REPLAY_CHUNK_CHARS])
+
+
+def finish_reason(response):
+    """回應 (串流時為最後一個 chunk) 第一個 candidate 的結束原因，例如 STOP、MAX_TOKENS、SAFETY；無法取得時回傳 None"""
+    try: reason = response.candidates[0].finish_reason
+    except Exception: return None
+    return getattr(reason, "name", None) or str(reason)
+
+
+def _complete(response, model):
+    # 只有正常結束 (STOP) 的輸出才寫入快取；被 MAX_TOKENS / SAFETY 截斷的試卷不可當成完整結果重播
+    reason = finish_reason(response)
+    if reason == "STOP": return True
+    metrics.inc("gemini_incomplete", model=model, reason=reason)
+    return False
+
+
+def chunk_text(chunk):
+    # 結尾或被封鎖的 chunk 沒有文字內容，存取 .text 會丟出 ValueError
+    try: return chunk.text or ""
+    except Exception: return ""
+
+
+class _MeteredStream:
+    """包裝串流回應：記錄首個 chunk 的等待時間、整段串流時間與 token 用量；
+    串流讀完 (或中途放棄) 時才歸還排程名額"""
+
+    def __init__(self, response, model, key, started, release=None):
+        self._response = response
+        self._model = model
+        self._key = key and mask_key(key)
+        self._started = started
+        self._release = release
+
+    def __iter__(self):
+        last = None
+        try:
+            for chunk in self._response:
+                if last is None:
+                    metrics.observe("gemini_ttft_seconds", time.perf_counter() - self._started, model=self._model, key=self._key)
+                last = chunk
+                yield chunk
+        finally:
+            if self._release: self._release()
+        metrics.observe("gemini_stream_seconds", time.perf_counter() - self._started, model=self._model, key=self._key)
+        if last is not None: metrics.record_usage(last, self._model)
+
+    def __del__(self):
+        # 從未迭代就被丟棄的串流也要歸還名額 (release 可重複呼叫)
+        if self._release: self._release()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class _RecordingStream:
+    """包裝串流回應：邊產出邊累積，完整結束後才寫入快取"""
+
+    cached = False
+
+    def __init__(self, response, cache, key, accept, model=None):
+        self._response = response
+        self._cache = cache
+        self._key = key
+        self._accept = accept
+        self._model = model
+
+    def __iter__(self):
+        parts = []
+        last = None
+        for chunk in self._response:
+            parts.append(chunk_text(chunk))
+            last = chunk
+            yield chunk
+        text = "".join(parts)
+        if text and _complete(last, self._model) and (self._accept is None or self._accept(text)):
+            self._cache.set(self._key, {"text": text})
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+def generate_with_retry(model_or_chat, prompt, stream=True, pool=None, keys=None,
+                        cache_key=None, force_fresh=False, accept=None):
+    """送出請求；有 key 池時依健康度選 key，429 / 無效 key 會立即切換到其他 key。
+    給定 cache_key 時先查回應快取 (force_fresh 可略過)；正常結束 (STOP) 且通過 accept 檢查的輸出才寫入快取。
+    在 scheduler.request_context 內呼叫時，實際送出前會先向排程器取得名額 (串流讀完才歸還)。"""
+    cache = None
+    if cache_key is not None:
+        try: cache = get_response_cache()
+        except Exception: cache = None
+    if cache is not None and not force_fresh:
+        hit = cache.get(cache_key)
+        if hit is not None:
+            metrics.inc("response_cache_hits")
+            return CachedResponse(hit["text"])
+        metrics.inc("response_cache_misses")
+
+    request = scheduler.current_request()
+    release = None
+    if request is not None:
+        scheduler.check_cancelled()
+        release = scheduler.get_scheduler().acquire(request.session, request.priority, request.on_wait, request=request)
+    started = time.perf_counter()
+    try:
+        response, key = _generate(model_or_chat, prompt, stream, pool, keys)
+    except BaseException:
+        if release: release()
+        raise
+    if stream: response = _MeteredStream(response, _model_name(model_or_chat), key, started, release)
+    else:
+        if release: release()
+        metrics.record_usage(response, _model_name(model_or_chat))
+    if cache is None: return response
+    if stream: return _RecordingStream(response, cache, cache_key, accept, _model_name(model_or_chat))
+    try:
+        text = response.text
+        if text and _complete(response, _model_name(model_or_chat)) and (accept is None or accept(text)):
+            cache.set(cache_key, {"text": text})
+    except Exception:
+        pass
+    return response
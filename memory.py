@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import tempfile
+
+# --- 記憶體控管：大段文字改存暫存檔、估算各 session 佔用量、讀取行程 RSS ---
+
+SPILL_BYTES = int(os.environ.get("QUESTWIZ_SPILL_KB", "256")) * 1024   # 超過此大小的文字存入暫存檔
+SPILL_DIR = os.path.join(tempfile.gettempdir(), "questwiz-spill")
+SPILL_TTL = 24 * 3600     # 行程異常結束留下的暫存檔，超過此秒數後清除
+MAX_DEPTH = 4             # 估算巢狀容器大小時最多往下幾層
+
+_swept = False
+
+
+def _sweep():
+    """清除過期的暫存檔 (每個行程只做一次)"""
+    global _swept
+    if _swept: return
+    _swept = True
+    now = time.time()
+    try:
+        for entry in os.scandir(SPILL_DIR):
+            if now - entry.stat().st_mtime > SPILL_TTL:
+                try: os.remove(entry.path)
+                except OSError: pass
+    except OSError:
+        pass
+
+
+class SpilledText:
+    """長文字存入暫存檔，記憶體中只留路徑；短文字直接保留。物件被丟棄時刪除暫存檔"""
+
+    def __init__(self, text):
+        self.chars = len(text)
+        data = text.encode("utf-8")
+        self.nbytes = len(data)
+        self.path = None
+        self._text = text
+        if self.nbytes <= SPILL_BYTES: return
+        try:
+            os.makedirs(SPILL_DIR, exist_ok=True)
+            _sweep()
+            fd, path = tempfile.mkstemp(prefix="material-", suffix=".txt", dir=SPILL_DIR)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except OSError:
+            return   # 暫存目錄不可寫時留在記憶體
+        self.path = path
+        self._text = None
+
+    def read(self):
+        if self._text is not None: return self._text
+        with open(self.path, encoding="utf-8") as f:
+            return f.read()
+
+    def resident_bytes(self):
+        return sys.getsizeof(self._text) if self._text is not None else sys.getsizeof(self.path)
+
+    def __len__(self):
+        return self.chars
+
+    def discard(self):
+        if self.path is None: return
+        try: os.remove(self.path)
+        except OSError: pass
+        self.path = None
+        self._text = ""
+
+    def __del__(self):
+        self.discard()
+
+
+def approx_size(obj, depth=0):
+    """估算物件佔用的位元組 (DataFrame 含字串內容；容器往下 MAX_DEPTH 層)"""
+    if isinstance(obj, SpilledText): return obj.resident_bytes()
+    if hasattr(obj, "memory_usage") and hasattr(obj, "columns"):
+        try: return int(obj.memory_usage(index=True, deep=True).sum())
+        except Exception: return sys.getsizeof(obj)
+    if isinstance(obj, (bytes, bytearray, memoryview)): return len(obj)
+    if hasattr(obj, "getbuffer"):   # BytesIO / 上傳檔
+        try: return obj.getbuffer().nbytes
+        except Exception: return sys.getsizeof(obj)
+    size = sys.getsizeof(obj)
+    if depth >= MAX_DEPTH: return size
+    if isinstance(obj, dict):
+        size += sum(approx_size(k, depth + 1) + approx_size(v, depth + 1) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approx_size(v, depth + 1) for v in obj)
+    return size
+
+
+def session_usage(state):
+    """回傳 (總位元組, [(項目, 位元組)] 由大到小)；state 為 st.session_state 或一般 dict"""
+    items = []
+    for key in list(state.keys()):
+        try: items.append((str(key), approx_size(state[key])))
+        except Exception: continue
+    items.sort(key=lambda item: item[1], reverse=True)
+    return sum(size for _, size in items), items
+
+
+def process_rss():
+    """目前行程的常駐記憶體 (位元組)；無法取得時回傳 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 以 KB 計，macOS 以 bytes 計 (此為峰值而非目前值)
+        return peak if sys.platform == "darwin" else peak * 1024
+    except Exception:
+        return None
+
+
+def format_bytes(n):
+    if n is None: return "-"
+    for unit in ("B", "KB", "MB"):
+        if n < 1024: return f"{n:,.0f} {unit}"
+        n /= 1024
+    return f"{n:,.1f} GB"
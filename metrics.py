@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import atexit
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from disk_cache import CACHE_DIR
+
+# --- 效能監控：計數器、滾動延遲分佈與計時區段，輸出為 JSONL 事件檔與 Prometheus 文字檔 ---
+#
+# 全部在記憶體中累計，每隔 EXPORT_INTERVAL 秒才寫檔一次，熱路徑上只有加鎖與 append。
+# metrics.prom 可直接給 node_exporter 的 textfile collector 讀取；events.jsonl 每行一個事件。
+
+METRICS_DIR = os.environ.get("QUESTWIZ_METRICS_DIR", os.path.join(CACHE_DIR, "metrics"))
+WINDOW = 500                  # 每個分佈保留最近幾筆
+EXPORT_INTERVAL = 15          # 寫檔間隔 (秒)
+MAX_EVENTS_BYTES = 20 * 1024 * 1024   # events.jsonl 超過此大小時輪替為 .1
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs: return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    """累計分佈 (Prometheus 輸出用) 加上最近 WINDOW 筆觀測值 (側欄 p50 / p95 用)"""
+
+    def __init__(self, window=WINDOW):
+        self.values = deque(maxlen=window)
+        self.count = 0      # 啟動以來總筆數 (不受視窗限制)
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)   # 各上限 (le) 的累計筆數
+
+    def observe(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound: self.buckets[i] += 1
+
+    def quantile(self, q):
+        if not self.values: return None
+        ordered = sorted(self.values)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Registry:
+    """行程內共用的指標登錄處"""
+
+    def __init__(self, directory=METRICS_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._events = []
+        self._last_export = time.monotonic()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_export()
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None: hist = self._histograms[key] = Histogram()
+            hist.observe(value)
+            self._events.append({"ts": round(time.time(), 3), "metric": name, "value": round(value, 4), **dict(key[1])})
+        self._maybe_export()
+
+    @contextmanager
+    def span(self, name, **labels):
+        """計時區段：結束時記錄秒數；發生例外時另外累計 {name}_errors"""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            # st.rerun / st.stop 以例外實作，不算錯誤
+            if isinstance(e, Exception): self.inc(f"{name}_errors", **labels)
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """回傳 (計數器列表, 分佈摘要列表)，供管理面板顯示"""
+        with self._lock:
+            counters = [(name, dict(labels), value) for (name, labels), value in sorted(self._counters.items())]
+            hists = [
+                {"metric": name, "labels": dict(labels), "count": h.count,
+                 "p50": h.quantile(0.5), "p95": h.quantile(0.95), "max": max(h.values) if h.values else None}
+                for (name, labels), h in sorted(self._histograms.items())
+            ]
+        return counters, hists
+
+    def render_prometheus(self):
+        """Prometheus 文字格式；計數與分佈皆為啟動以來的累計值 (rate / histogram_quantile 才正確)"""
+        lines = []
+        typed = set()
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed: lines.append(f"# TYPE questwiz_{name}_total counter")
+                typed.add(name)
+                lines.append(f"questwiz_{name}_total{_format_labels(labels)} {value}")
+            for (name, labels), h in sorted(self._histograms.items()):
+                if name not in typed: lines.append(f"# TYPE questwiz_{name} histogram")
+                typed.add(name)
+                for bound, n in zip(BUCKETS, h.buckets):
+                    lines.append(f"questwiz_{name}_bucket{_format_labels(labels, [('le', bound)])} {n}")
+                lines.append(f"questwiz_{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {h.count}")
+                lines.append(f"questwiz_{name}_sum{_format_labels(labels)} {h.total:.6f}")
+                lines.append(f"questwiz_{name}_count{_format_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def _maybe_export(self):
+        if time.monotonic() - self._last_export >= EXPORT_INTERVAL: self.export()
+
+    def export(self):
+        """寫出 metrics.prom (整份取代) 並把累積的事件附加到 events.jsonl；寫檔失敗不影響主流程"""
+        with self._lock:
+            events, self._events = self._events, []
+            self._last_export = time.monotonic()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            events_path = os.path.join(self.directory, "events.jsonl")
+            if events:
+                if os.path.exists(events_path) and os.path.getsize(events_path) > MAX_EVENTS_BYTES:
+                    os.replace(events_path, events_path + ".1")
+                with open(events_path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(e, ensure_ascii=False) + "\n" for e in events)
+            prom_path = os.path.join(self.directory, "metrics.prom")
+            tmp = prom_path + f".{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(self.render_prometheus())
+            os.replace(tmp, prom_path)
+        except OSError:
+            pass
+
+
+registry = Registry()
+atexit.register(registry.export)
+
+inc = registry.inc
+observe = registry.observe
+span = registry.span
+
+
+def record_usage(response, model):
+    """由 usage_metadata 累計輸入 / 輸出 token 數 (串流時在最後一個 chunk 上)"""
+    usage = getattr(response, "usage_metadata", None)
+    if not usage: return
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    if prompt_tokens: inc("gemini_prompt_tokens", prompt_tokens, model=model)
+    if output_tokens: inc("gemini_output_tokens", output_tokens, model=model)
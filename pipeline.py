@@ -0,0 +1,223 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from chunking import estimate_tokens, split_material, merge_tables
+from llm import generate_with_retry, response_cache_key, new_model, chunk_text
+from scheduler import propagate
+from prompts import (GEM_INSTRUCTIONS_PHASE1, GEM_INSTRUCTIONS_PHASE3, build_phase1_prompt,
+                     build_phase3_prompt, build_section_prompt)
+from sections import Section, plan_sections, assemble_exam, check_scores, find_questions, renumber_questions
+from question_bank import parse_items, assign_rows, map_exam_rows, row_key
+from tables import IncrementalTableParser, parse_md_to_df, df_to_string
+
+# --- Phase 1 分析流程：教材過大時分段並行擷取目標，再合併成一張審核表 ---
+# --- Phase 3 分段命題：各大題並行生成 (部分列可由題庫補上)，再依審核表順序組回試卷 ---
+
+PHASE1_CONFIG = {"temperature": 0.0}
+MAX_PARALLEL_CHUNKS = 4
+MAX_PARALLEL_SECTIONS = 4
+
+
+def is_table_response(text):
+    return "|" in text and "單元" in text
+
+
+def is_exam_response(text):
+    return bool(find_questions(text))
+
+
+def _analyze_chunk(chunk, grade, subject, selected_types, model_name, pool, keys, force_fresh, part, on_rows=None):
+    # 每段各自建立 model：bind_key 會改動 model 的 client，不能跨執行緒共用
+    model = new_model(
+        model_name=model_name,
+        system_instruction=GEM_INSTRUCTIONS_PHASE1,
+        generation_config=PHASE1_CONFIG
+    )
+    chat = model.start_chat(history=[])
+    prompt = build_phase1_prompt(grade, subject, selected_types, chunk, part=part)
+    response = generate_with_retry(
+        chat, prompt, stream=on_rows is not None, pool=pool, keys=keys,
+        cache_key=response_cache_key(model_name, GEM_INSTRUCTIONS_PHASE1, PHASE1_CONFIG, prompt),
+        force_fresh=force_fresh,
+        accept=is_table_response
+    )
+    if on_rows is None: return response.text
+
+    # 串流：每完成一列就回報，讓老師在生成途中就能開始檢視
+    parser = IncrementalTableParser()
+    parts = []
+    for chunk_ in response:
+        text = chunk_text(chunk_)
+        parts.append(text)
+        if parser.feed(text): on_rows(parser)
+    if parser.close(): on_rows(parser)
+    return "".join(parts)
+
+
+def analyze_material(content, grade, subject, selected_types, model_name, pool=None, keys=None,
+                     force_fresh=False, on_progress=None, on_preview=None, max_workers=MAX_PARALLEL_CHUNKS):
+    """產出學習目標審核表，回傳 (DataFrame, 原始 Markdown)；格式異常時 DataFrame 為 None。
+    on_progress(完成段數, 總段數) 與 on_preview(目前的未校正表格) 都在呼叫端執行緒中回報。"""
+    chunks = split_material(content)
+    if len(chunks) == 1:
+        on_rows = (lambda parser: on_preview(parser.to_df(finalize=False))) if on_preview else None
+        text = _analyze_chunk(chunks[0], grade, subject, selected_types, model_name, pool, keys, force_fresh, None,
+                              on_rows=on_rows)
+        if not is_table_response(text): return None, text
+        # 題型清洗與配分校正等串流結束後才一次套用
+        return parse_md_to_df(text), text
+
+    total = len(chunks)
+    texts = [None] * total
+    with ThreadPoolExecutor(max_workers=min(max_workers, total)) as executor:
+        futures = {
+            executor.submit(propagate(_analyze_chunk), chunk, grade, subject, selected_types, model_name,
+                            pool, keys, force_fresh, (i + 1, total)): i
+            for i, chunk in enumerate(chunks)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            texts[futures[future]] = future.result()
+            if on_progress: on_progress(done, total)
+            if on_preview:
+                ready = [i for i, t in enumerate(texts) if t is not None and is_table_response(t)]
+                partial = merge_tables([parse_md_to_df(texts[i]) for i in ready], [estimate_tokens(chunks[i]) for i in ready])
+                if partial is not None: on_preview(partial)
+
+    if not all(is_table_response(t) for t in texts): return None, "\n\n".join(texts)
+    dfs = [parse_md_to_df(t) for t in texts]
+    merged = merge_tables(dfs, [estimate_tokens(c) for c in chunks])
+    return merged, "\n\n".join(texts)
+
+
+def _generate_section(section, grade, subject, mode, model_name, pool, keys, force_fresh, index=None):
+    model = new_model(model_name=model_name, system_instruction=GEM_INSTRUCTIONS_PHASE3)
+    # 只附上與本大題各列相關的教材段落，prompt 長度不隨教材總量成長
+    context = index.context_for_rows(section.rows) if index is not None else ""
+    prompt = build_section_prompt(grade, subject, mode, section.q_type, df_to_string(section.rows), section.score, context)
+    response = generate_with_retry(
+        model, prompt, stream=False, pool=pool, keys=keys,
+        cache_key=response_cache_key(model_name, GEM_INSTRUCTIONS_PHASE3, None, prompt),
+        force_fresh=force_fresh,
+        # 配分與審核表不符的大題不快取，下次重新生成
+        accept=lambda text: is_exam_response(text) and check_scores(section, text) is None
+    )
+    return response.text
+
+
+def _join_rows(texts):
+    """接起各列的試題：各段可能取自不同試卷，題號先改為從 1 起連續，組裝時才能依序重新編號"""
+    parts, next_no = [], 1
+    for text in texts:
+        text, next_no = renumber_questions(text, next_no)
+        parts.append(text)
+    return "\n\n".join(parts)
+
+
+def _splice_rows(section, positions, reused_texts, pending, text):
+    """依審核表列順序組合大題：沿用的列放回原位置，新生成的試題依配分分給其餘各列；
+    無法逐列對應 (配分不符或題號前有共用文字) 時整段放在第一個新列的位置"""
+    slots = [None] * len(section.rows)
+    for pos, reused in zip(positions, reused_texts): slots[pos] = reused
+    missing = [pos for pos, slot in enumerate(slots) if slot is None]
+    questions = find_questions(text)
+    groups = assign_rows(parse_items(text, section.q_type), pending.rows, section.score_col) if questions and not text[:questions[0].start()].strip() else []
+    if len(groups) == len(missing):
+        for pos, (_, items) in zip(missing, groups): slots[pos] = "\n\n".join(item["body"] for item in items)
+    else:
+        slots[missing[0]] = text
+    return _join_rows(slot for slot in slots if slot)
+
+
+def _fill_section(section, reuse, grade, subject, mode, model_name, pool, keys, force_fresh, bank, index):
+    """生成一個大題：已補上的列 (題庫或上一版試卷) 直接沿用，只為其餘各列呼叫模型"""
+    positions, reused_texts = reuse or ([], [])
+    rest = section.rows.drop(section.rows.index[positions]) if positions else section.rows
+    if not len(rest): return _join_rows(reused_texts)
+    pending = Section(section.index, section.q_type, rest, section.score_col)
+    text = _generate_section(pending, grade, subject, mode, model_name, pool, keys, force_fresh, index)
+    if bank is not None:
+        # 新生成的試題存入題庫；存檔失敗不影響命題
+        try: bank.store_section(pending, text, grade, subject, mode)
+        except Exception: pass
+    if not positions: return text
+    return _splice_rows(section, positions, reused_texts, pending, text)
+
+
+def carry_over(df, previous_df, previous_text, grade, subject, mode):
+    """比對上一版審核表與試卷，找出內容未變、可直接沿用試題的列。
+    回傳 {大題 index: ([列位置], [試題文字])} (格式同 QuestionBank.pick_reuse)"""
+    mapping = map_exam_rows(previous_df, previous_text, grade, subject, mode)
+    carried = {}
+    for section in plan_sections(df):
+        for pos, row in enumerate(section.rows.to_dict("records")):
+            # 相同內容的列可能有好幾列，依序各取一份
+            texts = mapping.get(row_key(row, section.q_type, grade, subject, mode))
+            if not texts: continue
+            positions, bodies = carried.setdefault(section.index, ([], []))
+            positions.append(pos)
+            bodies.append(texts.pop(0))
+    return carried
+
+
+def generate_exam_sections(df, grade, subject, mode, model_name, pool=None, keys=None, force_fresh=False,
+                           on_section=None, max_workers=MAX_PARALLEL_SECTIONS, bank=None, reuse_ratio=0.0, index=None,
+                           reuse=None):
+    """依題型分段並行命題，回傳 (完整試卷, 配分警告)。
+    on_section(大題, 文字) 會在呼叫端執行緒中依完成順序回報。
+    有 bank 時新試題會存入題庫，並依 reuse_ratio (配分比例) 由題庫補上部分列，只生成其餘的列。
+    index 為教材檢索索引，各大題只附上相關段落。
+    reuse 為已決定沿用的列 (例如 carry_over 的結果)；給定時不再由題庫補題。"""
+    sections = plan_sections(df)
+    if reuse is None:
+        reuse = {}
+        if bank is not None and reuse_ratio > 0 and not force_fresh:
+            try: reuse = bank.pick_reuse(sections, grade, subject, mode, reuse_ratio)
+            except Exception: reuse = {}
+    texts = [None] * len(sections)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(sections)))) as executor:
+        futures = {
+            executor.submit(propagate(_fill_section), section, reuse.get(section.index), grade, subject, mode, model_name,
+                            pool, keys, force_fresh, bank, index): i
+            for i, section in enumerate(sections)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            texts[i] = future.result()
+            if on_section: on_section(sections[i], texts[i])
+    return assemble_exam(sections, texts)
+
+
+def generate_exam(df, grade, subject, mode, model_name, pool=None, keys=None, force_fresh=False, bank=None, index=None):
+    """整份試卷一次生成 (不串流)，供批次模式使用；有 bank 時試題會存入題庫"""
+    model = new_model(model_name=model_name, system_instruction=GEM_INSTRUCTIONS_PHASE3)
+    context = index.context_for_rows(df) if index is not None else ""
+    prompt = build_phase3_prompt(grade, subject, mode, df_to_string(df), context)
+    response = generate_with_retry(
+        model, prompt, stream=False, pool=pool, keys=keys,
+        cache_key=response_cache_key(model_name, GEM_INSTRUCTIONS_PHASE3, None, prompt),
+        force_fresh=force_fresh,
+        accept=is_exam_response
+    )
+    if bank is not None:
+        try: bank.store_exam(response.text, df, grade, subject, mode)
+        except Exception: pass
+    return response.text
+
+
+def generate_exam_stream(df, grade, subject, mode, model_name, pool=None, keys=None, force_fresh=False, index=None,
+                         on_text=None):
+    """整份試卷一次生成並串流，回傳 (完整試卷, 是否為快取重播)；on_text(新增文字) 於生成途中回報"""
+    model = new_model(model_name=model_name, system_instruction=GEM_INSTRUCTIONS_PHASE3)
+    context = index.context_for_rows(df) if index is not None else ""
+    prompt = build_phase3_prompt(grade, subject, mode, df_to_string(df), context)
+    response = generate_with_retry(
+        model, prompt, stream=True, pool=pool, keys=keys,
+        cache_key=response_cache_key(model_name, GEM_INSTRUCTIONS_PHASE3, None, prompt),
+        force_fresh=force_fresh,
+        accept=is_exam_response
+    )
+    parts = []
+    for chunk in response:
+        text = chunk_text(chunk)
+        parts.append(text)
+        if on_text and text: on_text(text)
+    return "".join(parts), getattr(response, "cached", False)
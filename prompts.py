@@ -0,0 +1,107 @@
+# --- 學科與題型映射 ---
+SUBJECT_Q_TYPES = {
+    "國語": ["國字注音", "造句", "單選題", "閱讀素養題", "句型變換", "簡答題"],
+    "數學": ["應用計算題", "圖表分析題", "填充題", "單選題", "是非題"],
+    "自然科學": ["實驗判讀題", "圖表分析題", "單選題", "是非題", "填充題", "配合題"],
+    "社會": ["地圖判讀題", "情境案例分析", "單選題", "是非題", "配合題", "簡答題"],
+    "英語": ["英語會話選擇", "詞彙搭配", "文意選填", "單選題", "閱讀理解"],
+    "": ["單選題", "是非題", "填充題", "簡答題"]
+}
+
+# --- Prompt 指令集 ---
+
+GEM_INSTRUCTIONS_PHASE1 = """
+你是「國小專業定期評量命題 AI」。
+Phase 1 任務：閱讀教材，整理【學習目標審核表】。
+
+絕對規則：
+1. **配分邏輯**：根據篇幅與重要性，分配總分剛好 100 分。
+2. **單一題型**：「對應題型」欄位只能選「一種」最適合的題型 (如：單選題)。
+   (❌錯誤: 單選題、配合題 | ✅正確: 單選題)
+3. **數字格式**：「預計配分」欄位只能填阿拉伯數字。
+4. **格式要求**：僅輸出 Markdown 表格。
+"""
+
+GEM_INSTRUCTIONS_PHASE3 = """
+你是「國小專業定期評量命題 AI」，精通 1-6 年級全科教材教法。
+Phase 3 任務：依據使用者確認的【試題審核表】與【命題模式】進行正式出題。
+
+### 1. 核心參數：試卷模式 (Mode)
+請依據輸入的模式調整命題邏輯：
+* **🟢 模式 A：適中 (Moderate)**：基礎學力，題幹直接。
+* **🔴 模式 B：困難 (Hard)**：邏輯細節，多步驟解題。
+* **🌟 模式 C：素養 (Literacy)**：情境解決問題，接軌國際標準。
+
+### 2. 命題鐵律
+* **總分**：必須嚴格遵守審核表中的配分，總分 100。
+* **視覺化**：若題目需要圖片，請在題幹插入  標籤。
+* **選項品質**：干擾項必須合理，禁止「以上皆是/非」。
+
+### 3. 輸出格式
+請直接輸出試卷內容，包含題號、題目、選項、配分。
+"""
+
+def build_phase1_prompt(grade, subject, selected_types, content, part=None):
+    """組出 Phase 1 的分析指令；part=(第幾段, 總段數) 表示只分析部分教材"""
+    t_str = "、".join(selected_types)
+    scope = ""
+    if part is not None:
+        scope = f"""
+    【範圍】以下為教材第 {part[0]}/{part[1]} 部分，只需整理本部分出現的單元與學習目標，
+    並依本部分內容分配 100 分 (系統會再與其他部分合併)。"""
+    return f"""
+    任務：分析以下教材並產出審核表。
+    【參數】年級：{grade}, 科目：{subject}, 可用題型：{t_str}{scope}
+    【教材】{content}
+    【步驟】
+    1. 識別單元結構與學習目標。
+    2. 依重要性與篇幅分配 100 分。
+    3. 輸出 Markdown 表格。
+    """
+
+def _reference_block(context):
+    if not context: return ""
+    return f"""
+    【教材參考段落 (依審核表檢索，請以此為命題依據)】
+    {context}
+    """
+
+def build_phase3_prompt(grade, subject, mode, df_str, context=""):
+    """組出 Phase 3 的正式命題指令；context 為檢索出的教材段落"""
+    return f"""
+    請根據以下【審核通過的架構表】進行命題。
+    
+    【基本資訊】
+    年級：{grade}
+    科目：{subject}
+    命題模式：{mode}
+    
+    【審核表 (請依此架構出題)】
+    {df_str}
+    {_reference_block(context)}
+    【執行要求】
+    1. 題目數量與配分需與表格完全一致。
+    2. 若為素養模式，請務必設計情境題。
+    3. 請包含  標籤以標示圖片需求。
+    """
+
+def build_section_prompt(grade, subject, mode, q_type, df_str, score, context=""):
+    """組出單一大題 (同一題型) 的命題指令，供分段並行命題使用；context 為檢索出的教材段落"""
+    return f"""
+    請根據以下【審核表片段】命題，本次只負責試卷中的「{q_type}」這一大題。
+    
+    【基本資訊】
+    年級：{grade}
+    科目：{subject}
+    命題模式：{mode}
+    
+    【審核表片段 (請依每一列出題)】
+    {df_str}
+    {_reference_block(context)}
+    【執行要求】
+    1. 本大題總分必須剛好 {score} 分，題目數量與配分需與表格完全一致。
+    2. 只輸出題目本身：不要輸出試卷標題、大題標題或其他題型。
+    3. 題號從 1 開始，每題標註配分，例如「1. (2分) ……」。
+    4. 若為素養模式，請務必設計情境題。
+    5. 請包含  標籤以標示圖片需求。
+    """
@@ -0,0 +1,273 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from disk_cache import CACHE_DIR, connect
+from sections import SCORE_RE, find_questions, plan_sections
+from streaming import SECTION_RE
+
+# --- 本機題庫 (SQLite + FTS5)：保存每次命題的試題，之後依年級、科目、單元與題型重複利用 ---
+#
+# 每一列審核表對應一組試題 (group)：該列的單元、學習目標、題型與配分，以及依序出的幾道題。
+# 只有配分合計與該列完全一致的組才會存入，重用時整組取出，配分不需再調整。
+
+BANK_PATH = os.environ.get("QUESTWIZ_BANK_PATH", os.path.join(CACHE_DIR, "question_bank.sqlite"))
+FTS_TERMS = 16   # 學習目標最多取幾個三字詞組做全文比對
+
+OPTION_RE = re.compile(r"[（(]\s*([A-DＡ-Ｄ])\s*[)）]\s*(.+?)(?=\s*[（(]\s*[A-DＡ-Ｄ]\s*[)）]|\n|$)")
+HEADING_PREFIX_RE = re.compile(r"^(?:[一二三四五六七八九十]+[、．.]|第[一二三四五六七八九十]+大題[、．.:：]?|[壹貳參肆伍陸柒捌玖拾]+[、．.])")
+PAREN_RE = re.compile(r"[（(][^)）]*[)）]")
+WORD_RE = re.compile(r"[\W_]+")
+
+_bank = None
+_bank_lock = threading.Lock()
+
+
+def _clean(value):
+    return re.sub(r"\s+", "", str(value))
+
+
+def heading_type(line):
+    """由大題標題取出題型，例如「### 一、單選題 (共 20 分)」→「單選題」"""
+    text = line.strip().lstrip("#").strip().strip("*").strip()
+    text = HEADING_PREFIX_RE.sub("", text)
+    return PAREN_RE.sub("", text).strip().rstrip(":：").strip()
+
+
+def parse_items(text, q_type=""):
+    """將一段試題文字依題號切成單題：{題號, 題型, 配分, 題幹, 選項, 原文}；配分無法辨識時為 None"""
+    matches = find_questions(text)
+    items = []
+    for i, m in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        body = text[m.start():end].strip()
+        score = SCORE_RE.search(body)
+        options = [opt.strip() for _, opt in OPTION_RE.findall(body)]
+        first_option = OPTION_RE.search(body)
+        stem = body[len(m.group(0)):first_option.start() if first_option else len(body)]
+        stem = SCORE_RE.sub("", stem, count=1).replace("**", "").strip()
+        items.append({
+            "no": int(m.group(2)),
+            "q_type": q_type,
+            "score": int(score.group(1)) if score else None,
+            "stem": stem,
+            "options": options,
+            "body": body,
+        })
+    return items
+
+
+def split_exam(text):
+    """依大題標題切開整份試卷，回傳 [(題型, 該大題文字)]"""
+    blocks, heading, lines = [], None, []
+    for line in text.split("\n"):
+        if SECTION_RE.match(line):
+            if heading is not None: blocks.append((heading_type(heading), "\n".join(lines)))
+            heading, lines = line, []
+        elif heading is not None:
+            lines.append(line)
+    if heading is not None: blocks.append((heading_type(heading), "\n".join(lines)))
+    return blocks
+
+
+def assign_rows(items, rows, score_col):
+    """依配分累計將試題依序分配給審核表各列，回傳 [(列, [試題])]；只保留配分剛好吻合的列"""
+    if score_col is None or not items or any(item["score"] is None for item in items): return []
+    groups, pos = [], 0
+    records = rows.to_dict("records")
+    for n, row in enumerate(records):
+        target = int(row[score_col])
+        taken, total = [], 0
+        while pos < len(items) and (total < target or n == len(records) - 1):
+            taken.append(items[pos])
+            total += items[pos]["score"]
+            pos += 1
+        if taken and total == target: groups.append((row, taken))
+    return groups
+
+
+def _match_section(sections, q_type):
+    """依大題標題的題型找出對應的審核表大題"""
+    return next((s for s in sections if s.q_type and (s.q_type in q_type or q_type in s.q_type)), None)
+
+
+def row_key(row, q_type, grade, subject, mode):
+    """審核表一列的內容雜湊：年級、科目、模式、題型與各欄位值，任何一格改動都視為不同的列"""
+    payload = [grade, subject, mode, q_type] + sorted((str(k), str(v).strip()) for k, v in row.items())
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def map_exam_rows(df, text, grade, subject, mode):
+    """將試卷依大題標題與配分對應回審核表各列，回傳 {列雜湊: [該列試題文字]}。
+    無法依配分對應的列，以及題號前另有共用文字 (例如閱讀題組的文章) 的大題不列入"""
+    sections = plan_sections(df)
+    mapping = {}
+    for q_type, body in split_exam(text):
+        section = _match_section(sections, q_type)
+        questions = find_questions(body)
+        if section is None or not questions or body[:questions[0].start()].strip(): continue
+        for row, items in assign_rows(parse_items(body, section.q_type), section.rows, section.score_col):
+            key = row_key(row, section.q_type, grade, subject, mode)
+            mapping.setdefault(key, []).append("\n\n".join(item["body"] for item in items))
+    return mapping
+
+
+def _fts_query(text):
+    # FTS5 trigram：中文不需斷詞，取學習目標中的三字詞組以 OR 比對，依 bm25 排序
+    text = WORD_RE.sub("", str(text))
+    grams = list(dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2)))[:FTS_TERMS]
+    return " OR ".join(f'"{g}"' for g in grams)
+
+
+class QuestionBank:
+    """以審核表列為單位存取試題的本機題庫"""
+
+    def __init__(self, path=BANK_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with connect(self.path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS groups (
+                    id INTEGER PRIMARY KEY,
+                    group_key TEXT UNIQUE NOT NULL,
+                    grade TEXT, subject TEXT, mode TEXT,
+                    unit TEXT, objective TEXT, q_type TEXT,
+                    score INTEGER NOT NULL,
+                    used INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS items (
+                    id INTEGER PRIMARY KEY,
+                    group_id INTEGER NOT NULL REFERENCES groups(id) ON DELETE CASCADE,
+                    seq INTEGER NOT NULL,
+                    score INTEGER NOT NULL,
+                    stem TEXT, options TEXT, body TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_groups_lookup ON groups(grade, subject, mode, q_type, unit, score)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_items_group ON items(group_id, seq)")
+            try:
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS groups_fts USING fts5(unit, objective, stems, tokenize='trigram')")
+                self.fts = True
+            except sqlite3.OperationalError:
+                # 舊版 SQLite 沒有 trigram：退回只依結構欄位比對
+                self.fts = False
+
+    def store_section(self, section, text, grade, subject, mode):
+        """存入一個大題的試題，回傳新增的組數"""
+        unit_col = next((c for c in section.rows.columns if "單元" in c), None)
+        goal_col = next((c for c in section.rows.columns if "目標" in c), None)
+        groups = assign_rows(parse_items(text, section.q_type), section.rows, section.score_col)
+        added = 0
+        now = time.time()
+        with self._lock, connect(self.path) as conn:
+            for row, items in groups:
+                unit = _clean(row[unit_col]) if unit_col else ""
+                objective = str(row[goal_col]).strip() if goal_col else ""
+                meta = [grade, subject, mode, unit, objective, section.q_type, int(row[section.score_col])]
+                # 相同內容 (例如快取重播、題號不同) 只存一次
+                content = [[i["score"], i["stem"], i["options"]] for i in items]
+                group_key = hashlib.sha256(json.dumps(meta + content, ensure_ascii=False).encode("utf-8")).hexdigest()
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO groups (group_key, grade, subject, mode, unit, objective, q_type, score, created) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [group_key] + meta + [now],
+                )
+                if not cur.rowcount: continue
+                group_id = cur.lastrowid
+                conn.executemany(
+                    "INSERT INTO items (group_id, seq, score, stem, options, body) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(group_id, seq, i["score"], i["stem"], json.dumps(i["options"], ensure_ascii=False), i["body"])
+                     for seq, i in enumerate(items)],
+                )
+                if self.fts:
+                    conn.execute("INSERT INTO groups_fts (rowid, unit, objective, stems) VALUES (?, ?, ?, ?)",
+                                 (group_id, unit, objective, "\n".join(i["stem"] for i in items)))
+                added += 1
+        return added
+
+    def store_exam(self, text, df, grade, subject, mode):
+        """存入整份試卷 (非分段命題)：依大題標題對應到審核表的題型"""
+        sections = plan_sections(df)
+        added = 0
+        for q_type, body in split_exam(text):
+            section = _match_section(sections, q_type)
+            if section is not None: added += self.store_section(section, body, grade, subject, mode)
+        return added
+
+    def _find_group(self, conn, grade, subject, mode, q_type, unit, objective, score, exclude):
+        where = "g.grade = ? AND g.subject = ? AND g.mode = ? AND g.q_type = ? AND g.unit = ? AND g.score = ?"
+        params = [grade, subject, mode, q_type, unit, score]
+        if exclude:
+            where += f" AND g.id NOT IN ({','.join('?' * len(exclude))})"
+            params += list(exclude)
+        query = _fts_query(objective) if self.fts else ""
+        if query:
+            # 學習目標需至少部分相符，越相近、越少被重用的組越優先
+            row = conn.execute(
+                f"SELECT g.id FROM groups_fts JOIN groups g ON g.id = groups_fts.rowid "
+                f"WHERE groups_fts MATCH ? AND {where} ORDER BY bm25(groups_fts), g.used LIMIT 1",
+                [query] + params,
+            ).fetchone()
+        else:
+            row = conn.execute(f"SELECT g.id FROM groups g WHERE {where} ORDER BY g.used, g.created DESC LIMIT 1",
+                               params).fetchone()
+        return row[0] if row else None
+
+    def pick_reuse(self, sections, grade, subject, mode, ratio):
+        """為各大題挑選可由題庫補上的列，重用配分合計不超過總分的 ratio。
+        回傳 {大題 index: ([列位置], [試題文字])}"""
+        total = sum(s.score for s in sections)
+        budget = total * ratio
+        if budget <= 0: return {}
+        picked, used_ids, reused = {}, [], 0
+        with self._lock, connect(self.path) as conn:
+            for section in sections:
+                if section.score_col is None: continue
+                unit_col = next((c for c in section.rows.columns if "單元" in c), None)
+                goal_col = next((c for c in section.rows.columns if "目標" in c), None)
+                for pos, row in enumerate(section.rows.to_dict("records")):
+                    score = int(row[section.score_col])
+                    if score <= 0 or reused + score > budget: continue
+                    group_id = self._find_group(
+                        conn, grade, subject, mode, section.q_type,
+                        _clean(row[unit_col]) if unit_col else "", row[goal_col] if goal_col else "", score, used_ids,
+                    )
+                    if group_id is None: continue
+                    bodies = [r[0] for r in conn.execute("SELECT body FROM items WHERE group_id = ? ORDER BY seq", (group_id,))]
+                    positions, texts = picked.setdefault(section.index, ([], []))
+                    positions.append(pos)
+                    texts.append("\n\n".join(bodies))
+                    used_ids.append(group_id)
+                    reused += score
+            if used_ids:
+                conn.execute(f"UPDATE groups SET used = used + 1 WHERE id IN ({','.join('?' * len(used_ids))})", used_ids)
+        return picked
+
+    def stats(self):
+        """回傳 (組數, 題數)"""
+        with connect(self.path) as conn:
+            groups = conn.execute("SELECT COUNT(*) FROM groups").fetchone()[0]
+            items = conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        return groups, items
+
+    def clear(self):
+        with self._lock, connect(self.path) as conn:
+            conn.execute("DELETE FROM items")
+            conn.execute("DELETE FROM groups")
+            if self.fts: conn.execute("DELETE FROM groups_fts")
+
+
+def get_question_bank():
+    """取得跨 session 共用的題庫"""
+    global _bank
+    with _bank_lock:
+        if _bank is None: _bank = QuestionBank()
+        return _bank
@@ -0,0 +1,134 @@
+import os
+import re
+import math
+import heapq
+import hashlib
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+from chunking import FILE_HEADER_RE, PAGE_SPLIT_RE
+
+# --- 教材檢索：以字元 bigram + BM25 為教材建立索引，Phase 3 每列只附上最相關的段落 ---
+#
+# 中文不需斷詞：連續的中日韓字元取 bigram，英數字取整個詞。
+# 索引依教材內容雜湊快取，同一份上傳只建一次。
+
+PASSAGE_CHARS = 400       # 每個段落約多少字
+TOP_K = 3                 # 每列附上的段落數
+MAX_CONTEXT_CHARS = 6000  # 每次 prompt 附上的段落總字數上限
+MAX_INDEXES = 8           # 記憶體中保留幾份教材的索引
+MAX_INDEX_CHARS = int(os.environ.get("QUESTWIZ_INDEX_MCHARS", "20")) * 1_000_000   # 所有索引合計的教材字數上限
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+CJK_RUN_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+|[A-Za-z0-9]+")
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def tokenize(text):
+    """中日韓字元取 bigram (單字成詞時取單字)，英數字轉小寫後整詞"""
+    tokens = []
+    for run in CJK_RUN_RE.findall(text):
+        if run.isascii(): tokens.append(run.lower())
+        elif len(run) == 1: tokens.append(run)
+        else: tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def _windows(text, size):
+    """依段落累積到約 size 字切段；單一段落過長時直接依字數切開"""
+    out, current = [], ""
+    for para in re.split(r"\n\s*\n|\n", text):
+        para = para.strip()
+        if not para: continue
+        while len(para) > size:
+            if current: out.append(current)
+            out.append(para[:size])
+            current, para = "", para[size:]
+        if current and len(current) + len(para) > size:
+            out.append(current)
+            current = ""
+        current = f"{current}\n{para}" if current else para
+    if current: out.append(current)
+    return out
+
+
+def split_passages(text, size=PASSAGE_CHARS):
+    """將抽取後的教材切成段落，回傳 [(出處, 內文)]；出處為「檔名 p.頁碼」"""
+    passages = []
+    parts = FILE_HEADER_RE.split(text)
+    files = [("", parts[0])] + [(parts[i], parts[i + 1]) for i in range(1, len(parts), 2)]
+    for name, body in files:
+        pages = PAGE_SPLIT_RE.split(body)
+        tagged = [("", pages[0])] + [(pages[i], pages[i + 1]) for i in range(1, len(pages), 2)]
+        for page, content in tagged:
+            label = f"{name} p.{page}" if page else name
+            passages.extend((label.strip(), chunk) for chunk in _windows(content, size))
+    return passages
+
+
+class RetrievalIndex:
+    """段落的 BM25 倒排索引"""
+
+    def __init__(self, passages):
+        self.passages = passages
+        self.chars = sum(len(content) for _, content in passages)
+        self.postings = defaultdict(list)   # token → [(段落編號, 次數)]
+        self.lengths = []
+        for doc_id, (_, content) in enumerate(passages):
+            counts = Counter(tokenize(content))
+            self.lengths.append(sum(counts.values()))
+            for token, tf in counts.items():
+                self.postings[token].append((doc_id, tf))
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+
+    def search(self, query, k=TOP_K):
+        """回傳與 query 最相關的 k 個段落編號 (依分數高到低)"""
+        n = len(self.passages)
+        if not n: return []
+        scores = defaultdict(float)
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings: continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc_id] / (self.avg_length or 1))
+                scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores, key=scores.get)
+
+    def context_for_rows(self, rows, k=TOP_K, max_chars=MAX_CONTEXT_CHARS):
+        """為審核表各列 (以單元 + 學習目標查詢) 取最相關段落，去除重複後組成參考資料文字"""
+        query_cols = [c for c in rows.columns if "單元" in c or "目標" in c]
+        if not query_cols or not self.passages: return ""
+        ranked = [self.search(" ".join(str(row[c]) for c in query_cols), k) for row in rows.to_dict("records")]
+        # 依名次輪流取各列的段落，字數上限先滿足每一列最相關的那段
+        picked = []
+        for rank in range(k):
+            for hits in ranked:
+                if rank < len(hits) and hits[rank] not in picked: picked.append(hits[rank])
+        out, total = [], 0
+        for doc_id in picked:
+            label, content = self.passages[doc_id]
+            block = f"[{label}]\n{content}" if label else content
+            if total + len(block) > max_chars: continue
+            out.append(block)
+            total += len(block)
+        return "\n\n".join(out)
+
+
+def get_index(text):
+    """取得教材的檢索索引；相同內容只建一次，最多保留 MAX_INDEXES 份、合計 MAX_INDEX_CHARS 字 (LRU)"""
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with _indexes_lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+    index = RetrievalIndex(split_passages(text))
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > MAX_INDEXES: _indexes.popitem(last=False)
+        # 最新的一份即使單獨超過字數上限也保留
+        while len(_indexes) > 1 and sum(i.chars for i in _indexes.values()) > MAX_INDEX_CHARS: _indexes.popitem(last=False)
+    return index
@@ -0,0 +1,222 @@
+import os
+import time
+import functools
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+
+# --- 跨 session 請求排程：全域併發上限、各 session 輪流、Phase 1 優先，排隊時回報位置與預估等待 ---
+#
+# 呼叫端以 request_context(session, priority, on_wait) 標記「誰、哪個階段」在送請求，
+# llm.generate_with_retry 實際呼叫模型前向排程器取得名額 (快取命中不佔名額)。
+# 標記存在 contextvar 中；丟到執行緒池的工作需以 propagate() 包裝才會帶過去。
+# 推測性命題 (SPECULATIVE) 排在正式命題之後且不老化；標記上的 priority / cancelled 可在途中變更，
+# 排隊中的請求隨即依新優先序排序，被取消的請求在下一次送出或排隊時丟出 Cancelled。
+
+MAX_CONCURRENT = int(os.environ.get("QUESTWIZ_MAX_CONCURRENT", "8"))   # 整個 process 同時進行的模型請求上限
+QUEUE_TIMEOUT = int(os.environ.get("QUESTWIZ_QUEUE_TIMEOUT", "900"))   # 排隊超過此秒數即放棄
+AGING_SECONDS = 60        # Phase 3 排隊超過此秒數後視同 Phase 1，避免被持續湧入的短請求餓死 (推測性請求不老化)
+POLL_SECONDS = 1.0        # 排隊中更新位置 / 預估等待的間隔
+MAX_SESSIONS = 1000       # 輪流順序最多記住幾個 session
+
+PHASE1 = 0
+PHASE3 = 1
+SPECULATIVE = 2           # 預先命題：只用正式請求剩下的名額
+DEFAULT_SECONDS = {PHASE1: 20.0, PHASE3: 60.0, SPECULATIVE: 60.0}   # 尚無實測資料時的預估佔用秒數
+
+_current = contextvars.ContextVar("questwiz_request", default=None)
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class QueueTimeout(Exception):
+    """排隊超過 QUEUE_TIMEOUT 仍未輪到"""
+
+
+class Cancelled(Exception):
+    """請求所屬的工作已被取消"""
+
+
+class RequestContext:
+    def __init__(self, session, priority, on_wait=None):
+        self.session = session
+        self.priority = priority
+        self.on_wait = on_wait
+        self.cancelled = False
+
+
+@contextmanager
+def request_context(session, priority, on_wait=None):
+    """此區塊內 (含以 propagate 包裝的背景工作) 的模型請求都經由排程器，回傳標記本身。
+    on_wait(狀態) 會在排隊期間與輪到時呼叫，狀態見 Scheduler.status()。"""
+    request = RequestContext(session, priority, on_wait)
+    token = _current.set(request)
+    try:
+        yield request
+    finally:
+        _current.reset(token)
+
+
+def current_request():
+    return _current.get()
+
+
+def check_cancelled():
+    """目前的請求已被取消時丟出 Cancelled"""
+    request = _current.get()
+    if request is not None and request.cancelled: raise Cancelled("工作已取消")
+
+
+def propagate(fn):
+    """讓 fn 在執行緒池中執行時沿用目前的 request_context (每個工作各複製一份 context)"""
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+class _Ticket:
+    def __init__(self, session, priority, request=None):
+        self.session = session
+        self._priority = priority
+        self.request = request
+        self.enqueued = time.monotonic()
+        self.started = None
+
+    @property
+    def priority(self):
+        # 推測性工作轉為正式工作時，排隊中的請求也跟著提前
+        return self.request.priority if self.request is not None else self._priority
+
+
+class Scheduler:
+    """行程內共用的請求排程器"""
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT):
+        self.max_concurrent = max(1, max_concurrent)
+        self._cond = threading.Condition()
+        self._waiting = []          # 依到達順序
+        self._running = []
+        self._last_served = {}      # session -> 最近一次取得名額的時間 (輪流順序依此排)
+        self._durations = {p: deque(maxlen=50) for p in DEFAULT_SECONDS}
+
+    def _effective_priority(self, ticket, now):
+        priority = ticket.priority
+        if priority == PHASE3 and now - ticket.enqueued >= AGING_SECONDS: return PHASE1
+        return priority
+
+    def _order(self, now):
+        """目前排隊者的放行順序：先依 (老化後的) 優先序，同優先序內各 session 輪流，最久沒輪到的先"""
+        order = []
+        for priority in sorted(DEFAULT_SECONDS):
+            queues = {}
+            for ticket in self._waiting:
+                if self._effective_priority(ticket, now) == priority:
+                    queues.setdefault(ticket.session, deque()).append(ticket)
+            sessions = sorted(queues, key=lambda s: self._last_served.get(s, 0.0))
+            while sessions:
+                for session in list(sessions):
+                    order.append(queues[session].popleft())
+                    if not queues[session]: sessions.remove(session)
+        return order
+
+    def _avg_seconds(self, priority):
+        durations = self._durations.get(priority)
+        return sum(durations) / len(durations) if durations else DEFAULT_SECONDS.get(priority, 30.0)
+
+    def _status(self, session, now):
+        order = self._order(now)
+        positions = [i for i, t in enumerate(order) if t.session == session]
+        running = sum(t.session == session for t in self._running)
+        if not positions: return {"waiting": 0, "running": running, "position": 0, "eta": 0}
+        first = positions[0]
+        # 前面的請求與執行中請求的剩餘時間，平均分攤到所有名額上
+        work = sum(self._avg_seconds(t.priority) for t in order[:first])
+        work += sum(max(self._avg_seconds(t.priority) - (now - t.started), 1.0) for t in self._running)
+        idle = len(self._running) < self.max_concurrent and first == 0
+        return {"waiting": len(positions), "running": running, "position": first + 1,
+                "eta": 0 if idle else round(work / self.max_concurrent)}
+
+    def status(self, session):
+        """{"waiting": 排隊中請求數, "running": 執行中請求數, "position": 最前面的排隊位置 (1 起算), "eta": 預估等待秒數}"""
+        with self._cond:
+            return self._status(session, time.monotonic())
+
+    def acquire(self, session, priority, on_wait=None, timeout=QUEUE_TIMEOUT, request=None):
+        """等待輪到並取得名額，回傳 release()；release 可重複呼叫。
+        給定 request (RequestContext) 時優先序隨 request.priority 變動，request 被取消時丟出 Cancelled"""
+        ticket = _Ticket(session, priority, request)
+        deadline = ticket.enqueued + timeout
+        notified = False
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if request is not None and request.cancelled: raise Cancelled("工作已取消")
+                    if len(self._running) < self.max_concurrent and self._order(now)[0] is ticket: break
+                    if now >= deadline:
+                        metrics.inc("scheduler_timeouts")
+                        raise QueueTimeout("目前使用人數眾多，排隊逾時，請稍後再試")
+                    if on_wait:
+                        status = self._status(session, now)
+                        # 回呼在鎖外執行，避免介面更新拖住其他排隊者
+                        self._cond.release()
+                        try: on_wait(status)
+                        finally: self._cond.acquire()
+                        notified = True
+                    self._cond.wait(timeout=min(POLL_SECONDS, max(0.0, deadline - time.monotonic())))
+            except BaseException:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+                raise
+            self._waiting.remove(ticket)
+            ticket.started = time.monotonic()
+            self._running.append(ticket)
+            self._last_served[session] = ticket.started
+            status = self._status(session, ticket.started) if notified else None
+        metrics.observe("scheduler_wait_seconds", ticket.started - ticket.enqueued, priority=ticket.priority)
+        if status is not None:
+            # 曾顯示排隊提示才需要再通知一次 (更新或清除)
+            try: on_wait(status)
+            except Exception: pass
+
+        released = []
+
+        def release():
+            with self._cond:
+                if released: return
+                released.append(True)
+                self._running.remove(ticket)
+                self._durations[ticket.priority].append(time.monotonic() - ticket.started)
+                if len(self._last_served) > MAX_SESSIONS: self._prune_sessions()
+                self._cond.notify_all()
+        return release
+
+    def _prune_sessions(self):
+        # 只保留仍有請求的 session 與最近取得名額的一半，其餘視同新 session
+        active = {t.session for t in self._running + self._waiting}
+        recent = set(sorted(self._last_served, key=self._last_served.get)[len(self._last_served) // 2:])
+        self._last_served = {s: self._last_served[s] for s in self._last_served if s in active or s in recent}
+
+    @contextmanager
+    def slot(self, session, priority, on_wait=None):
+        release = self.acquire(session, priority, on_wait)
+        try:
+            yield
+        finally:
+            release()
+
+    def snapshot(self):
+        """{"running", "waiting", "limit", "sessions"}，供管理面板顯示"""
+        with self._cond:
+            sessions = {t.session for t in self._running + self._waiting}
+            return {"running": len(self._running), "waiting": len(self._waiting),
+                    "limit": self.max_concurrent, "sessions": len(sessions)}
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None: _scheduler = Scheduler()
+        return _scheduler
@@ -0,0 +1,97 @@
+import re
+
+from streaming import SECTION_RE
+
+# --- 分段命題：依審核表題型拆成大題，並行生成後依表格順序組回完整試卷 ---
+
+CN_NUMERALS = ["一", "二", "三", "四", "五", "六", "七", "八", "九", "十",
+               "十一", "十二", "十三", "十四", "十五", "十六", "十七", "十八", "十九", "二十"]
+
+# 題號：行首 (不可縮排) 的「1.」「1、」「1)」「**1.**」，後面須接空白或中文，
+# 避免把「3.5 元」這類小數或縮排的配合題選項「   1. 蘋果」當成題號
+QUESTION_RE = re.compile(r"^((?:\*\*)?)(\d+)([.、．)）])(?=(?:\*\*)?(?:\s|[^\x00-\x7f]))", re.M)
+SCORE_RE = re.compile(r"[（(]\s*(\d+)\s*分\s*[)）]")
+
+
+class Section:
+    """一個大題：同一「對應題型」的審核表列"""
+
+    def __init__(self, index, q_type, rows, score_col):
+        self.index = index
+        self.q_type = q_type
+        self.rows = rows
+        self.score_col = score_col
+        self.score = int(rows[score_col].sum()) if score_col else 0
+
+    @property
+    def title(self):
+        numeral = CN_NUMERALS[self.index] if self.index < len(CN_NUMERALS) else str(self.index + 1)
+        return f"{numeral}、{self.q_type} (共 {self.score} 分)"
+
+
+def _find_col(df, keyword):
+    return next((col for col in df.columns if keyword in col), None)
+
+
+def plan_sections(df):
+    """依「對應題型」分組，大題順序依題型在審核表中首次出現的位置"""
+    type_col = _find_col(df, "題型")
+    score_col = _find_col(df, "配分")
+    if type_col is None: return [Section(0, "試題", df, score_col)]
+    order = list(dict.fromkeys(str(t).strip() for t in df[type_col]))
+    return [
+        Section(i, q_type, df[df[type_col].astype(str).str.strip() == q_type], score_col)
+        for i, q_type in enumerate(order)
+    ]
+
+
+def _strip_headings(text):
+    """移除模型自行加上的大題標題，大題標題統一由組裝時產生"""
+    lines = text.strip().split("\n")
+    while lines and (not lines[0].strip() or SECTION_RE.match(lines[0]) or lines[0].lstrip().startswith("#")):
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def find_questions(text):
+    """找出真正的題號 (QUESTION_RE 的 match)：題號須依序遞增，由第一個題號起算；
+    題目內容中剛好出現在行首的其他數字 (跳號) 不算"""
+    found = []
+    for m in QUESTION_RE.finditer(text):
+        if found and int(m.group(2)) != int(found[-1].group(2)) + 1: continue
+        found.append(m)
+    return found
+
+
+def renumber_questions(text, start=1):
+    """將題號改為從 start 起連續編號，回傳 (新文字, 下一個題號)"""
+    parts, pos, n = [], 0, start
+    for m in find_questions(text):
+        parts.append(text[pos:m.start()] + f"{m.group(1)}{n}{m.group(3)}")
+        pos = m.end()
+        n += 1
+    parts.append(text[pos:])
+    return "".join(parts), n
+
+
+def check_scores(section, text):
+    """比對題目標示的配分總和與審核表是否一致；無法辨識配分時回傳 None"""
+    scores = [int(s) for s in SCORE_RE.findall(text)]
+    if not scores: return None
+    total = sum(scores)
+    if total == section.score: return None
+    return f"「{section.q_type}」標示配分合計 {total} 分，審核表為 {section.score} 分"
+
+
+def assemble_exam(sections, texts):
+    """依大題順序組合試卷：加上大題標題、題號全卷連續編號，並回傳配分檢查警告"""
+    parts, warnings = [], []
+    next_no = 1
+    total = sum(s.score for s in sections)
+    if total != 100: warnings.append(f"審核表總分為 {total} 分，不是 100 分")
+    for section, text in zip(sections, texts):
+        body, next_no = renumber_questions(_strip_headings(text), next_no)
+        warning = check_scores(section, body)
+        if warning: warnings.append(warning)
+        parts.append(f"### {section.title}\n\n{body}")
+    return "\n\n".join(parts), warnings
@@ -0,0 +1,66 @@
+import re
+import time
+
+# --- Phase 3 串流顯示：緩衝 chunk、節流刷新、完成的大題固定不再重繪 ---
+
+FLUSH_INTERVAL = 0.25   # 至少間隔多久刷新一次畫面 (秒)
+FLUSH_CHARS = 600       # 或累積多少字就立即刷新
+CURSOR = "▌"
+
+# 大題標題：一、／第一大題／壹、(可帶 Markdown 標題或粗體前綴)
+SECTION_RE = re.compile(
+    r"^[ \t]*(?:#{1,4}[ \t]*)?(?:\*\*)?[ \t]*(?:[一二三四五六七八九十]+[、．.]|第[一二三四五六七八九十]+大題|[壹貳參肆伍陸柒捌玖拾]+[、．.])",
+    re.M,
+)
+
+
+class StreamRenderer:
+    """將串流文字分段顯示：已完成的大題各自成為獨立元素，只有進行中的尾段會重繪"""
+
+    def __init__(self, container, flush_interval=FLUSH_INTERVAL, flush_chars=FLUSH_CHARS):
+        self.container = container
+        self.flush_interval = flush_interval
+        self.flush_chars = flush_chars
+        self._buffer = []       # 尚未刷新的 chunk
+        self._pending = 0
+        self._frozen = []       # 已固定的大題文字
+        self._tail = ""         # 進行中的大題文字
+        self._tail_slot = container.empty()
+        self._last_flush = time.monotonic()
+
+    @property
+    def text(self):
+        return "".join(self._frozen) + self._tail + "".join(self._buffer)
+
+    def write(self, text):
+        if not text: return
+        self._buffer.append(text)
+        self._pending += len(text)
+        now = time.monotonic()
+        if self._pending >= self.flush_chars or now - self._last_flush >= self.flush_interval:
+            self._flush(now)
+
+    def _flush(self, now, final=False):
+        if self._buffer:
+            self._tail += "".join(self._buffer)
+            self._buffer.clear()
+        self._pending = 0
+        self._last_flush = now
+        # 尾段中若已出現下一個大題標題，前面的內容就不會再變動，固定成獨立元素
+        starts = [m.start() for m in SECTION_RE.finditer(self._tail) if m.start() > 0]
+        prev = 0
+        for start in starts:
+            self._freeze(self._tail[prev:start])
+            prev = start
+        self._tail = self._tail[prev:]
+        self._tail_slot.markdown(self._tail if final else self._tail + CURSOR)
+
+    def _freeze(self, section):
+        self._tail_slot.markdown(section)
+        self._frozen.append(section)
+        self._tail_slot = self.container.empty()
+
+    def close(self):
+        """刷新剩餘內容並移除游標，回傳完整文字"""
+        self._flush(time.monotonic(), final=True)
+        return self.text
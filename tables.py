@@ -0,0 +1,135 @@
+import io
+import re
+
+import pandas as pd
+
+# --- 審核表資料處理工具 ---
+
+def clean_number(x):
+    nums = re.findall(r"[-+]?\d*\.\d+|\d+", str(x))
+    return float(nums[0]) if nums else 0.0
+
+def normalize_scores(df, score_col):
+    """將配分等比例縮放為總分 100 的整數，四捨五入的誤差補在最高分那一列"""
+    current_total = df[score_col].sum()
+    
+    if current_total > 0 and current_total != 100:
+        df[score_col] = (df[score_col] / current_total) * 100
+    
+    df[score_col] = df[score_col].round().astype(int)
+    
+    diff = 100 - df[score_col].sum()
+    if diff != 0:
+        max_idx = df[score_col].idxmax()
+        df.loc[max_idx, score_col] += diff
+    return df
+
+class IncrementalTableParser:
+    """邊接收串流文字邊解析 Markdown 表格，每完成一列就可取得"""
+
+    def __init__(self):
+        self._pending = ""
+        self._started = False
+        self.headers = None
+        self.rows = []
+
+    def feed(self, text):
+        """餵入一段串流文字，回傳本次新完成的列"""
+        self._pending += text
+        lines = self._pending.split('\n')
+        self._pending = lines.pop()
+        return self._consume_lines(lines)
+
+    def close(self):
+        """串流結束：處理最後一行 (沒有換行結尾)"""
+        lines, self._pending = [self._pending], ""
+        return self._consume_lines(lines)
+
+    def _consume_lines(self, lines):
+        new_rows = []
+        for raw in lines:
+            for line in raw.replace("||", "|\n|").split('\n'):
+                if ("單元" in line or "目標" in line or "配分" in line) and "|" in line:
+                    self._started = True
+                elif not self._started or "---" in line or "|" not in line:
+                    continue
+                row = [cell.strip() for cell in line.strip('|').split('|')]
+                if self.headers is None:
+                    self.headers = row
+                    continue
+                max_cols = len(self.headers)
+                if len(row) < max_cols: row = row + [''] * (max_cols - len(row))
+                row = row[:max_cols]
+                self.rows.append(row)
+                new_rows.append(row)
+        return new_rows
+
+    def to_df(self, finalize=True):
+        """目前已解析的表格；finalize=True 時套用題型清洗與配分校正"""
+        if self.headers is None or not self.rows: return None
+        df = pd.DataFrame(self.rows, columns=self.headers)
+        return finalize_table(df) if finalize else df
+
+def finalize_table(df):
+    """表格完整後的清洗：題型只留第一個、配分校正為總分 100"""
+    # --- 🔥 強制清洗貪心題型 (只留第一個) ---
+    type_col = next((col for col in df.columns if "題型" in col), None)
+    if type_col:
+        def clean_type(x):
+            txt = str(x).replace(" ", "")
+            if "、" in txt: return txt.split("、")[0]
+            if "," in txt: return txt.split(",")[0]
+            if "或" in txt: return txt.split("或")[0]
+            return txt
+        df[type_col] = df[type_col].apply(clean_type)
+
+    # --- 🔥 配分自動校正 ---
+    score_col = next((col for col in df.columns if "配分" in col), None)
+    if score_col:
+        try:
+            df[score_col] = df[score_col].apply(clean_number)
+            normalize_scores(df, score_col)
+        except: pass
+        
+    return df
+
+def parse_md_to_df(md_text):
+    """將 Markdown 表格解析為 Pandas DataFrame"""
+    try:
+        parser = IncrementalTableParser()
+        parser.feed(md_text.strip())
+        parser.close()
+        return parser.to_df()
+    except Exception as e: return None
+
+def df_to_excel(df):
+    """將 DataFrame 轉為 Excel bytes"""
+    try:
+        output = io.BytesIO()
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            df.to_excel(writer, index=False, sheet_name='學習目標審核表')
+            workbook = writer.book
+            worksheet = writer.sheets['學習目標審核表']
+            
+            wrap_format = workbook.add_format({'text_wrap': True, 'valign': 'vcenter'})
+            header_format = workbook.add_format({
+                'bold': True, 'text_wrap': True, 'valign': 'vcenter', 
+                'fg_color': '#D7E4BC', 'border': 1
+            })
+            num_format = workbook.add_format({'valign': 'vcenter', 'align': 'center'})
+
+            for col_num, value in enumerate(df.columns.values):
+                worksheet.write(0, col_num, value, header_format)
+
+            worksheet.set_column(0, 0, 15, wrap_format)
+            worksheet.set_column(1, 1, 55, wrap_format) 
+            worksheet.set_column(2, 2, 20, wrap_format)
+            worksheet.set_column(3, 3, 10, num_format)
+                
+        return output.getvalue()
+    except Exception as e: return None
+
+def df_to_string(df):
+    """將 DataFrame 轉為文字字串，供 Prompt 使用"""
+    if df is None: return ""
+    return df.to_markdown(index=False)